@@ -0,0 +1,215 @@
+"""
+Benchmark of the config shell operations on synthetic clusters, built on the
+Salt mocks of the test suite.
+
+Usage: python -m benchmarks.cluster [--sizes 10,1000,10000] [--output FILE]
+                                    [--simulation FILE]
+
+With --simulation, the scenarios run against the simulated Salt backend
+configured by the given profile (its minions and data_dir are ignored), which
+models the Salt latencies and failures.
+"""
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+import yaml
+from mock import patch
+
+from sesboot.config_shell import SesBootConfigShell, generate_config_shell_tree
+from sesboot.inventory import InventorySnapshot
+from sesboot.model import SesNodeManager
+from sesboot.salt_sim import SimulationProfile
+from sesboot.salt_utils import MinionDataCache, MinionKeysManager, PillarManager, SaltClient
+from tests import SaltClientMock, SaltLocalClientMock
+
+
+# number of pillar keys written by the pillar set throughput scenario
+PILLAR_SETS = 100
+
+
+class ClusterSaltClient(SaltClientMock):
+    """
+    Salt client mock whose pillar and PKI directories are in a real temporary
+    directory, holding the keys of the synthetic minions
+    """
+    base_dir = None
+
+    @classmethod
+    def pillar_fs_path(cls):
+        return os.path.join(cls.base_dir, 'pillar')
+
+    @classmethod
+    def pki_dir(cls):
+        return os.path.join(cls.base_dir, 'pki')
+
+
+def synthetic_cluster(base_dir, minions):
+    """
+    Creates the accepted keys and the grains of the minions, none of them is a
+    SES node yet
+    """
+    local = SaltLocalClientMock()
+    ClusterSaltClient.local_client = local
+    ClusterSaltClient.base_dir = base_dir
+    keys_dir = os.path.join(ClusterSaltClient.pki_dir(), 'minions')
+    os.makedirs(keys_dir)
+    os.makedirs(ClusterSaltClient.pillar_fs_path())
+    for idx in range(minions):
+        minion = 'node{}.ses'.format(idx)
+        open(os.path.join(keys_dir, minion), 'w').close()
+        local.grains[minion].grains['fqdn_ip4'] = [
+            '10.{}.{}.{}'.format(idx // 65536, (idx // 256) % 256, idx % 256)]
+    return local
+
+
+class Scenarios:
+    """
+    Runs the scenarios in order, on the same shell, recording the wall time
+    and number of Salt jobs of each one
+    """
+    def __init__(self, local):
+        self.local = local
+        self.shell = None
+        self.results = {}
+
+    @contextlib.contextmanager
+    def _measure(self, name, operations=None):
+        jobs = len(self.local.jobs)
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        result = {'time': elapsed, 'salt_calls': len(self.local.jobs) - jobs}
+        if operations:
+            result['ops_per_sec'] = operations / elapsed
+        self.results[name] = result
+
+    def _run(self, cmdline):
+        # the shell console keeps its own reference to stdout
+        with open(os.devnull, 'w') as devnull, \
+                patch.object(self.shell.con, '_stdout', devnull):
+            self.shell.run_cmdline(cmdline)
+
+    def run(self):
+        with self._measure('tree_generation'):
+            self.shell = SesBootConfigShell()
+            generate_config_shell_tree(self.shell)
+
+        with self._measure('minions_glob_add'):
+            self._run('/Cluster/Minions add node*')
+
+        SesNodeManager.invalidate()
+        with self._measure('node_manager_load'):
+            SesNodeManager.ses_nodes()
+
+        with self._measure('role_assignment'):
+            self._run('/Cluster/Roles/Mon add node1*')
+
+        with self._measure('ls_rendering'):
+            self._run('ls /')
+
+        with self._measure('pillar_set', operations=PILLAR_SETS):
+            for idx in range(PILLAR_SETS):
+                PillarManager.set('ses:benchmark:key{}'.format(idx), idx)
+
+        with self._measure('role_removal'):
+            self._run('/Cluster/Roles/Mon rm node1*')
+
+        with self._measure('minions_glob_rm'):
+            self._run('/Cluster/Minions rm node*')
+
+        return self.results
+
+
+def _simulated_cluster(base_dir, minions, simulation):
+    settings = dict(simulation, minions=['node{}.ses'.format(idx) for idx in range(minions)],
+                    data_dir=base_dir)
+    return patch.multiple(SaltClient, simulation=SimulationProfile(**settings), _LOCAL_=None)
+
+
+def run(minions, simulation=None):
+    base_dir = tempfile.mkdtemp(prefix='sesboot-benchmark-')
+    try:
+        if simulation is None:
+            salt_client = patch('sesboot.salt_utils.SaltClient', new=ClusterSaltClient)
+        else:
+            salt_client = _simulated_cluster(base_dir, minions, simulation)
+        with salt_client, patch.object(InventorySnapshot, 'enabled', False):
+            local = synthetic_cluster(base_dir, minions) if simulation is None \
+                else SaltClient.local()
+            PillarManager.invalidate()
+            MinionKeysManager.invalidate()
+            MinionDataCache.invalidate()
+            SesNodeManager.invalidate()
+            return Scenarios(local).run()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+@contextlib.contextmanager
+def _temporary_home():
+    """
+    The shell stores its preferences and log in the home directory, which are
+    shared by all the shells created by the process
+    """
+    home = os.environ.get('HOME')
+    home_dir = tempfile.mkdtemp(prefix='sesboot-benchmark-home-')
+    os.environ['HOME'] = home_dir
+    try:
+        yield
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+        shutil.rmtree(home_dir)
+
+
+@click.command()
+@click.option('--sizes', default='10,1000,10000',
+              help="comma separated numbers of minions of the synthetic clusters")
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help="file to store the results as JSON")
+@click.option('--simulation', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="simulated Salt backend profile, instead of the test mocks")
+def main(sizes, output, simulation):
+    # the Salt mocks log every call
+    logging.disable(logging.CRITICAL)
+    settings = None
+    if simulation:
+        with open(simulation, 'r') as file:
+            settings = yaml.safe_load(file) or {}
+        settings = {key: val for key, val in settings.items()
+                    if key not in ('minions', 'data_dir')}
+    results = {}
+    with _temporary_home():
+        for size in [int(size) for size in sizes.split(',')]:
+            click.echo("Running scenarios with {} minions...".format(size), err=True)
+            results[str(size)] = run(size, settings)
+
+    row = "{:>8} {:<20} {:>10} {:>11} {:>10}"
+    click.echo(row.format("minions", "scenario", "time (s)", "salt calls", "ops/s"))
+    for size, scenarios in results.items():
+        for name, res in scenarios.items():
+            click.echo(row.format(size, name, "{:.4f}".format(res['time']), res['salt_calls'],
+                                  "{:.1f}".format(res['ops_per_sec'])
+                                  if 'ops_per_sec' in res else '-'))
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({
+                'timestamp': time.time(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'simulation': settings,
+                'results': results
+            }, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -43,7 +43,7 @@ BuildRequires:  python3-setuptools
 %if 0%{?suse_version}
 Requires:       python3-click >= 6.7
 Requires:       python3-configshell-fb >= 1.1
-Requires:       python3-pycryptodomex >= 3.4.6
+Requires:       python3-pycryptodomex >= 3.15.0
 Requires:       python3-PyYAML >= 3.13
 Requires:       python3-setuptools
 Requires:       python3-salt >= 2019.2.0
@@ -64,12 +64,14 @@ sesboot is a CLI tool for deploying SES clusters.
 %install
 %py3_install
 %fdupes %{buildroot}%{python3_sitelib}
+mkdir -p %{buildroot}%{_localstatedir}/cache/sesboot
 
 %files
 %license LICENSE
 %doc CHANGELOG.md README.md
 %{python3_sitelib}/sesboot*/
 %{_bindir}/sesboot
+%dir %attr(0700, root, root) %{_localstatedir}/cache/sesboot
 
 %changelog
 
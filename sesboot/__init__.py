@@ -1,12 +1,17 @@
 import logging
 import logging.config
+import re
 import sys
 
 import click
-import pkg_resources
 
-from .config_shell import run_config_cmdline, run_config_shell
+from .daemon import ConfigDaemon, send_commands
 from .exceptions import SesBootException
+from .inventory import InventorySnapshot
+from .metrics import Metrics, Profiler
+from .model import SesNodeManager
+from .salt_utils import PillarManager, SaltClient, SaltJobs
+from .serializers import SERIALIZERS
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +21,7 @@ def _setup_logging(log_level, log_file):
     Logging configuration
     """
     if log_level == "silent":
+        logging.getLogger().addHandler(logging.NullHandler())
         return
 
     logging.config.dictConfig({
@@ -44,6 +50,21 @@ def _setup_logging(log_level, log_file):
     })
 
 
+def _print_version(ctx, _param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    # pkg_resources is slow to import, only pay for it when the version is requested
+    import pkg_resources  # pylint: disable=import-outside-toplevel
+    click.echo(pkg_resources.get_distribution('sesboot'))
+    ctx.exit()
+
+
+def _validate_batch_size(_ctx, _param, value):
+    if value is not None and not re.match(r'^[1-9][0-9]*%?$', value):
+        raise click.BadParameter("must be a number of minions or a percentage, e.g. 10 or 25%")
+    return value
+
+
 def sesboot_main():
     try:
         # pylint: disable=unexpected-keyword-arg,no-value-for-parameter
@@ -51,6 +72,7 @@ def sesboot_main():
     except SesBootException as ex:
         logger.exception(ex)
         click.echo(str(ex))
+        sys.exit(1)
 
 
 @click.group()
@@ -60,22 +82,138 @@ def sesboot_main():
 @click.option('--log-file', default='/var/log/sesboot.log',
               type=click.Path(dir_okay=False),
               help="the file path for the log to be stored")
-@click.version_option(pkg_resources.get_distribution('sesboot'), message="%(version)s")
-def cli(log_level, log_file):
+@click.option('--pillar-refresh-target', default=None,
+              help="compound target of the minions to refresh after a pillar change "
+                   "(default: SES members)")
+@click.option('--pillar-refresh-affected-only', is_flag=True, default=False,
+              help="only refresh the minions whose pillar top file includes the changed pillar")
+@click.option('--pillar-format', default=None, type=click.Choice(sorted(SERIALIZERS)),
+              help="convert the pillar files to this format (default: keep the current "
+                   "format, yaml for a new pillar)")
+@click.option('--pillar-sharded/--pillar-single-file', default=None,
+              help="convert the pillar to one file per subtree, or back to a single file "
+                   "(default: keep the current layout)")
+@click.option('--pillar-journal', is_flag=True, default=False,
+              help="append pillar changes to a journal, written to the pillar files by a "
+                   "later change or at exit")
+@click.option('--grains-batch-size', default=None, callback=_validate_batch_size,
+              help="write grains in Salt batches of this number or percentage of minions")
+@click.option('--pillar-refresh-batch-size', default=None, callback=_validate_batch_size,
+              help="refresh the pillar in Salt batches of this number or percentage of minions")
+@click.option('--inventory-cache/--no-inventory-cache', default=True,
+              help="show the SES inventory from the local snapshot until it is revalidated "
+                   "against Salt (default: enabled)")
+@click.option('--live-membership', is_flag=True, default=False,
+              help="ping the minions to find the SES nodes, instead of reading the master "
+                   "minion data cache")
+@click.option('--public-ip-mine-function', default=None, metavar='FUNCTION',
+              help="Salt mine function (e.g. network.ip_addrs) whose first address is the "
+                   "public IP of each node (default: the fqdn_ip4 grain)")
+@click.option('--salt-simulation', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="replace the Salt master by a simulated cluster described in this YAML file")
+@click.option('--socket', 'socket_path', default=ConfigDaemon.socket_path,
+              type=click.Path(dir_okay=False),
+              help="Unix socket of the sesboot daemon (default: {})".format(
+                  ConfigDaemon.socket_path))
+@click.option('--stats', is_flag=True, default=False,
+              help="print the count and time of Salt calls and pillar operations at exit")
+@click.option('--profile', is_flag=True, default=False,
+              help="print a CPU (cProfile) and memory (tracemalloc) profile at exit")
+@click.option('--version', is_flag=True, expose_value=False, is_eager=True,
+              callback=_print_version, help="Show the version and exit.")
+def cli(log_level, log_file, pillar_refresh_target, pillar_refresh_affected_only, pillar_format,
+        pillar_sharded, pillar_journal, grains_batch_size, pillar_refresh_batch_size,
+        inventory_cache, live_membership, public_ip_mine_function, salt_simulation, socket_path,
+        stats, profile):
     _setup_logging(log_level, log_file)
+    if pillar_format:
+        PillarManager.serializer = SERIALIZERS[pillar_format]
+    PillarManager.sharded = pillar_sharded
+    PillarManager.journal = pillar_journal
+    if pillar_refresh_target:
+        PillarManager.refresh_target = pillar_refresh_target
+    PillarManager.refresh_affected_only = pillar_refresh_affected_only
+    SaltJobs.batch_sizes = {SaltJobs.GRAINS_WRITE: grains_batch_size,
+                            SaltJobs.PILLAR_REFRESH: pillar_refresh_batch_size}
+    InventorySnapshot.enabled = inventory_cache
+    if live_membership:
+        SesNodeManager.membership = 'live'
+    SesNodeManager.public_ip_mine_function = public_ip_mine_function
+    if salt_simulation:
+        from .salt_sim import SimulationProfile  # pylint: disable=import-outside-toplevel
+        SaltClient.simulation = SimulationProfile.load(salt_simulation)
+        # the inventory of the simulated cluster must not replace the real one
+        InventorySnapshot.CACHE_DIR = SaltClient.simulation.cache_dir()
+    ConfigDaemon.socket_path = socket_path
+    ctx = click.get_current_context()
+    if stats:
+        Metrics.enabled = True
+        ctx.call_on_close(lambda: click.echo(Metrics.summary(), err=True))
+    if profile:
+        Profiler.start()
+        ctx.call_on_close(Profiler.report)
+
+
+def _run_in_daemon(commands, stop_on_error):
+    try:
+        response = send_commands(commands, stop_on_error)
+    except SesBootException as ex:
+        logger.exception(ex)
+        click.echo("An error occurred: {}".format(ex))
+        click.get_current_context().exit(1)
+    if 'error' in response:
+        click.echo("An error occurred: {}".format(response['error']))
+        click.get_current_context().exit(1)
+    click.echo(response['output'], nl=False)
+    if response['failed']:
+        click.get_current_context().exit(1)
 
 
 @cli.command(name='config')
+@click.option('-f', '--file', 'script', type=click.File('r'), default=None,
+              help="run the commands of this file, one per line, and save the changes once "
+                   "at the end (use - for stdin)")
+@click.option('--stop-on-error', is_flag=True, default=False,
+              help="with --file, skip the remaining commands after the first failure")
+@click.option('--daemon', 'use_daemon', is_flag=True, default=False,
+              help="run the commands in the sesboot daemon (see 'sesboot serve')")
 @click.argument('config_args', nargs=-1, type=click.UNPROCESSED, required=False)
-def config_shell(config_args):
+def config_shell(script, stop_on_error, use_daemon, config_args):
     """
     Starts sesboot configuration shell
     """
-    if config_args:
+    if script is not None and config_args:
+        raise click.UsageError("a command cannot be combined with --file")
+    if use_daemon:
+        if script is not None:
+            commands = script.read().splitlines()
+        elif config_args:
+            commands = [" ".join(config_args)]
+        else:
+            raise click.UsageError("the interactive shell cannot run in the daemon")
+        _run_in_daemon(commands, stop_on_error)
+        return
+
+    # the configuration shell pulls in configshell, pyparsing and Salt
+    # pylint: disable=import-outside-toplevel
+    from .config_shell import run_config_cmdline, run_config_script, run_config_shell
+    if script is not None:
+        if run_config_script(script, stop_on_error):
+            click.get_current_context().exit(1)
+    elif config_args:
         run_config_cmdline(" ".join(config_args))
     else:
         run_config_shell()
 
 
+@cli.command(name='serve')
+def serve():
+    """
+    Runs the sesboot daemon, which keeps the Salt clients, pillar and SES
+    inventory loaded to serve 'sesboot config --daemon' commands
+    """
+    ConfigDaemon.serve()
+
+
 if __name__ == '__main__':
     sesboot_main()
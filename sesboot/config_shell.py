@@ -1,22 +1,29 @@
 # pylint: disable=arguments-differ
 import logging
 import fnmatch
-import base64
-import hashlib
+import sys
 
 from pyparsing import alphanums, OneOrMore, Optional, Regex, Suppress, Word
 
 import configshell_fb as configshell
 from configshell_fb.shell import locatedExpr
-from Cryptodome.PublicKey import RSA
 
+from .exceptions import GrainsUpdateException
 from .model import SesNodeManager
-from .salt_utils import PillarManager
+from .salt_utils import PillarManager, SaltJobs
+from .ssh_keys import SesSshKeyManager
 
 
 logger = logging.getLogger(__name__)
 
 
+# Salt jobs that take longer than this many seconds show a progress counter
+PROGRESS_DELAY = 1.0
+
+# nodes whose grains were cached longer than this many seconds ago are marked
+CACHE_AGE_WARNING = 60 * 60
+
+
 class OptionHandler:
     def value(self):
         return None, None
@@ -24,12 +31,24 @@ class OptionHandler:
     def save(self, value):
         pass
 
+    def revalidate(self):
+        """
+        Makes sure the value is up to date before it is changed
+        """
+
     def reset(self):
         pass
 
     def read_only(self):
         return False
 
+    def revision(self):
+        """
+        Returns a value that changes whenever the value is reloaded from its
+        source, or None if the value is always read from its source
+        """
+        return None
+
     def possible_values(self):
         return []
 
@@ -58,6 +77,28 @@ class PillarHandler(OptionHandler):
         return False
 
 
+class ClusterGroupHandler(OptionHandler):
+    def commands_map(self):
+        return {
+            'refresh': self.refresh
+        }
+
+    def refresh(self, source='cache'):
+        '''
+        Reloads the SES nodes from the master minion data cache, or from the
+        minions themselves with "refresh live"
+        '''
+        if source not in ['cache', 'live']:
+            raise Exception('source must be one of: cache, live')
+        SesNodeManager.revalidate(live=source == 'live')
+
+    def value(self):
+        age = SesNodeManager.snapshot_age()
+        if age is None:
+            return "", None
+        return "cached inventory from {}s ago, run 'refresh' to update".format(int(age)), False
+
+
 class RolesGroupHandler(OptionHandler):
     def value(self):
         minions = set()
@@ -97,23 +138,42 @@ class RoleHandler(OptionHandler):
         self._load()
         return self._value, True
 
+    def revision(self):
+        return SesNodeManager.revision()
+
+    def revalidate(self):
+        SesNodeManager.ensure_fresh()
+
     def save(self, value):
+        self.revalidate()
         self._load()
         _minions = set(value)
         to_remove = self._value - _minions
         to_add = _minions - self._value
 
+        nodes = []
         for minion in to_remove:
             SesNodeManager.ses_nodes()[minion].roles.remove(self.role)
-            SesNodeManager.ses_nodes()[minion].save()
+            nodes.append(SesNodeManager.ses_nodes()[minion])
 
         for minion in to_add:
             SesNodeManager.ses_nodes()[minion].add_role(self.role)
-            SesNodeManager.ses_nodes()[minion].save()
-
-        SesNodeManager.save_in_pillar()
-
-        self._value = set(value)
+            nodes.append(SesNodeManager.ses_nodes()[minion])
+
+        with PillarManager.transaction():
+            try:
+                SesNodeManager.save_nodes(nodes)
+            except GrainsUpdateException as ex:
+                # keep the previous roles of the nodes that could not be saved
+                for minion in ex.minions:
+                    if minion in to_add:
+                        SesNodeManager.ses_nodes()[minion].roles.discard(self.role)
+                    else:
+                        SesNodeManager.ses_nodes()[minion].add_role(self.role)
+                raise
+            finally:
+                SesNodeManager.save_in_pillar()
+                self._load()
 
     def children_handler(self, child_name):
         return RoleElementHandler(SesNodeManager.ses_nodes()[child_name], self.role)
@@ -124,96 +184,60 @@ class SesNodeHandler(OptionHandler):
         self.ses_node = ses_node
 
     def value(self):
+        age = self.ses_node.cache_age()
+        stale = " (grains cached {}h ago)".format(int(age // 3600)) \
+            if age is not None and age > CACHE_AGE_WARNING else ""
         if not self.ses_node.roles:
-            return 'no roles', False
-        return ", ".join(self.ses_node.roles), None
+            return 'no roles' + stale, False
+        return ", ".join(self.ses_node.roles) + stale, None
 
 
 class SesNodesHandler(OptionHandler):
     def __init__(self):
-        self._minions = set()
         self._ses_nodes = set()
 
     def value(self):
         self._ses_nodes = {n.minion_id for n in SesNodeManager.ses_nodes().values()}
         return self._ses_nodes, True
 
+    def revision(self):
+        return SesNodeManager.revision()
+
+    def revalidate(self):
+        SesNodeManager.ensure_fresh()
+
     def save(self, value):
+        self.revalidate()
+        self._ses_nodes = {n.minion_id for n in SesNodeManager.ses_nodes().values()}
         _value = set(value)
         to_remove = self._ses_nodes - _value
         to_add = _value - self._ses_nodes
 
-        for minion in to_remove:
-            SesNodeManager.remove_node(minion)
-        for minion in to_add:
-            SesNodeManager.add_node(minion)
-
-        self._ses_nodes = set(value)
+        with PillarManager.transaction():
+            try:
+                SesNodeManager.remove_nodes(to_remove)
+                SesNodeManager.add_nodes(to_add)
+            finally:
+                self._ses_nodes = {n.minion_id for n in SesNodeManager.ses_nodes().values()}
 
     def possible_values(self):
-        if not self._minions:
-            self._minions = set(SesNodeManager.list_all_minions())
-        return self._minions - self._ses_nodes
+        return SesNodeManager.list_all_minions() - self._ses_nodes
 
     def children_handler(self, child_name):
         return SesNodeHandler(SesNodeManager.ses_nodes()[child_name])
 
 
-class SesSshKeyManager:
-    @classmethod
-    def check_keys(cls, stored_priv_key, stored_pub_key):
-        try:
-            key = RSA.import_key(stored_priv_key)
-        except (ValueError, IndexError, TypeError):
-            raise Exception('invalid private key')
-
-        if not key.has_private():
-            raise Exception('invalid private key')
-
-        pub_key = key.publickey().exportKey('OpenSSH').decode('utf-8')
-        stored_pub_key = PillarManager.get('ses:ssh:public_key')
-        if not stored_pub_key or pub_key != stored_pub_key:
-            raise Exception('key pair does not match')
-
-    @classmethod
-    def check_public_key(cls, stored_priv_key, stored_pub_key):
-        if not stored_pub_key:
-            raise Exception('no public key set')
-        if not stored_priv_key:
-            raise Exception('private key does not match')
-        try:
-            cls.check_keys(stored_priv_key, stored_pub_key)
-        except Exception as ex:
-            if str(ex) == 'key pair does not match':
-                ex = Exception('private key does not match')
-            raise ex
-
-    @classmethod
-    def check_private_key(cls, stored_priv_key, stored_pub_key):
-        if not stored_priv_key:
-            raise Exception('no private key set')
-        if not stored_pub_key:
-            raise Exception('public key does not match')
-        try:
-            cls.check_keys(stored_priv_key, stored_pub_key)
-        except Exception as ex:
-            if str(ex) == 'key pair does not match':
-                ex = Exception('public key does not match')
-            raise ex
-
-
 class SSHGroupHandler(OptionHandler):
     def commands_map(self):
         return {
             'generate': self.generate_key_pair
         }
 
-    def generate_key_pair(self):
-        key = RSA.generate(2048)
-        private_key = key.exportKey('PEM')
-        public_key = key.publickey().exportKey('OpenSSH')
-        PillarManager.set('ses:ssh:private_key', private_key.decode('utf-8'))
-        PillarManager.set('ses:ssh:public_key', public_key.decode('utf-8'))
+    def generate_key_pair(self, key_type='rsa'):
+        private_key, public_key = SesSshKeyManager.generate_key_pair(key_type)
+        with PillarManager.transaction():
+            PillarManager.set('ses:ssh:private_key', private_key)
+            PillarManager.set('ses:ssh:public_key', public_key)
 
     def value(self):
         stored_priv_key = PillarManager.get('ses:ssh:private_key')
@@ -224,7 +248,7 @@ class SSHGroupHandler(OptionHandler):
             return "invalid key pair", False
         try:
             SesSshKeyManager.check_keys(stored_priv_key, stored_pub_key)
-            return "Key Pair set", True
+            return "Key Pair set ({})".format(SesSshKeyManager.key_type(stored_pub_key)), True
         except Exception:  # pylint: disable=broad-except
             return "invalid key pair", False
 
@@ -233,18 +257,13 @@ class SshPrivateKeyHandler(PillarHandler):
     def __init__(self):
         super(SshPrivateKeyHandler, self).__init__('ses:ssh:private_key')
 
-    @staticmethod
-    def _key_fingerprint(key):
-        key = base64.b64decode(key.split()[1].encode('ascii'))
-        fp_plain = hashlib.md5(key).hexdigest()
-        return ':'.join(a + b for a, b in zip(fp_plain[::2], fp_plain[1::2]))
-
     def value(self):
         stored_priv_key, _ = super(SshPrivateKeyHandler, self).value()
         stored_pub_key = PillarManager.get('ses:ssh:public_key')
         try:
             SesSshKeyManager.check_private_key(stored_priv_key, stored_pub_key)
-            return self._key_fingerprint(stored_pub_key), None
+            fingerprints = SesSshKeyManager.fingerprints(stored_priv_key, stored_pub_key)
+            return "{} ({})".format(*fingerprints), None
         except Exception as ex:  # pylint: disable=broad-except
             return str(ex), False
 
@@ -253,18 +272,13 @@ class SshPublicKeyHandler(PillarHandler):
     def __init__(self):
         super(SshPublicKeyHandler, self).__init__('ses:ssh:public_key')
 
-    @staticmethod
-    def _key_fingerprint(key):
-        key = base64.b64decode(key.split()[1].encode('ascii'))
-        fp_plain = hashlib.md5(key).hexdigest()
-        return ':'.join(a + b for a, b in zip(fp_plain[::2], fp_plain[1::2]))
-
     def value(self):
         stored_pub_key, _ = super(SshPublicKeyHandler, self).value()
         stored_priv_key = PillarManager.get('ses:ssh:private_key')
         try:
             SesSshKeyManager.check_public_key(stored_priv_key, stored_pub_key)
-            return self._key_fingerprint(stored_pub_key), None
+            fingerprints = SesSshKeyManager.fingerprints(stored_priv_key, stored_pub_key)
+            return "{} ({})".format(*fingerprints), None
         except Exception as ex:  # pylint: disable=broad-except
             return str(ex), False
 
@@ -307,6 +321,7 @@ SESBOOT_OPTIONS = {
                 Options to specify the structure of the SES cluster, like
                 membership, roles, etc...
                 ''',
+        'handler': ClusterGroupHandler(),
         'options': {
             'Minions': {
                 'help': 'The list of salt minions that are used to deploy SES',
@@ -432,12 +447,12 @@ SESBOOT_OPTIONS = {
         'options': {
             'Private_Key': {
                 'default': None,
-                'help': "SSH RSA private key",
+                'help': "SSH private key (RSA or Ed25519)",
                 'handler': SshPrivateKeyHandler()
             },
             'Public_Key': {
                 'default': None,
-                'help': "SSH RSA public key",
+                'help': "SSH public key (RSA or Ed25519)",
                 'handler': SshPublicKeyHandler()
             },
         }
@@ -489,17 +504,47 @@ class SesBootRoot(configshell.ConfigNode):
         return "", None
 
 
-class GroupNode(configshell.ConfigNode):
-    def __init__(self, group_name, help, handler, parent):
+class LazyNodeMixin:
+    """
+    Defers the creation of the node children, and the loading of the data they
+    need, until the children are first accessed
+    """
+    _loaded = False
+
+    def _load_children(self):
+        pass
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            self._load_children()
+
+    @property
+    def children(self):
+        self._ensure_loaded()
+        return self._children
+
+    def get_child(self, name):
+        self._ensure_loaded()
+        return super(LazyNodeMixin, self).get_child(name)
+
+
+class GroupNode(LazyNodeMixin, configshell.ConfigNode):
+    def __init__(self, group_name, help, handler, parent, options=None):
         configshell.ConfigNode.__init__(self, group_name, parent)
         self.group_name = group_name
         self.help_intro = help
         self.handler = handler
+        self.options = options if options else {}
 
         if self.handler:
             for cmd, func in self.handler.commands_map().items():
                 setattr(self, 'ui_command_{}'.format(cmd), func)
 
+    def _load_children(self):
+        for option_name, option_dict in self.options.items():
+            _generate_option_node(option_name, option_dict, self)
+
     def list_commands(self):
         cmds = ['cd', 'ls', 'help', 'exit', 'reset', 'set']
         if self.handler:
@@ -632,9 +677,8 @@ class ListElementNode(configshell.ConfigNode):
         configshell.ConfigNode.__init__(self, value, parent)
 
 
-class ListOptionNode(OptionNode):
-    def __init__(self, option_name, option_dict, parent):
-        super(ListOptionNode, self).__init__(option_name, option_dict, parent)
+class ListOptionNode(LazyNodeMixin, OptionNode):
+    def _load_children(self):
         value_list, _ = self._find_value()
         self.value = list(value_list)
         for value in value_list:
@@ -648,12 +692,14 @@ class ListOptionNode(OptionNode):
         return str(len(value_list)) if value_list else 'empty', None
 
     def ui_command_add(self, value):
+        self._ensure_loaded()
         if value not in self.value:
             self.value.append(value)
             self.option_dict['handler'].save(self.value)
             ListElementNode(value, self)
 
     def ui_command_remove(self, value):
+        self._ensure_loaded()
         if value in self.value:
             self.value.remove(value)
             self.option_dict['handler'].save(self.value)
@@ -671,37 +717,77 @@ class MinionOptionNode(configshell.ConfigNode):
         return "", None
 
 
-class MinionsOptionNode(OptionNode):
-    def __init__(self, option_name, option_dict, parent):
-        super(MinionsOptionNode, self).__init__(option_name, option_dict, parent)
+class MinionsOptionNode(LazyNodeMixin, OptionNode):
+    # handler revision the children were built or synced at
+    _revision = None
+
+    def _load_children(self):
         value_list, _ = self._find_value()
+        self._revision = self.option_dict['handler'].revision()
         self.value = list(value_list)
         for value in value_list:
-            MinionOptionNode(value, option_dict['handler'].children_handler(value), self)
+            MinionOptionNode(value, self.option_dict['handler'].children_handler(value), self)
+
+    def _resync(self):
+        # the minions were reloaded (e.g. by '/Cluster refresh') since the children were built
+        if self._loaded and self._revision != self.option_dict['handler'].revision():
+            self._sync_value()
+
+    def _ensure_loaded(self):
+        self._resync()
+        super(MinionsOptionNode, self)._ensure_loaded()
 
     def _list_commands(self):
         return ['add', 'rm']
 
     def summary(self):
+        self._resync()
         value_list, val_type = self._find_value()
         if value_list:
             return "Minions: {}".format(str(len(value_list))), val_type
         return 'no minions', False
 
+    def _sync_value(self):
+        handler = self.option_dict['handler']
+        value_list, _ = handler.value()
+        # set before the children are accessed, which checks the revision
+        self._revision = handler.revision()
+        self.value = list(value_list)
+        for child in list(self.children):
+            if child.name not in value_list:
+                self.remove_child(child)
+        children = {child.name for child in self.children}
+        for value in self.value:
+            if value not in children:
+                MinionOptionNode(value, handler.children_handler(value), self)
+
     def ui_command_add(self, minion_id):
-        matching = fnmatch.filter(self.option_dict['handler'].possible_values(), minion_id)
-        for match in matching:
-            if match not in self.value:
-                self.value.append(match)
-                self.option_dict['handler'].save(self.value)
-                MinionOptionNode(match, self.option_dict['handler'].children_handler(match), self)
+        self._ensure_loaded()
+        self.option_dict['handler'].revalidate()
+        self._sync_value()
+        current = set(self.value)
+        matching = [match for match in
+                    fnmatch.filter(self.option_dict['handler'].possible_values(), minion_id)
+                    if match not in current]
+        if not matching:
+            return
+        # all matches are saved at once
+        try:
+            self.option_dict['handler'].save(self.value + matching)
+        finally:
+            self._sync_value()
 
     def ui_command_rm(self, minion_id):
-        matching = fnmatch.filter(self.value, minion_id)
-        for match in matching:
-            self.value.remove(match)
-            self.option_dict['handler'].save(self.value)
-            self.remove_child(self.get_child(match))
+        self._ensure_loaded()
+        self.option_dict['handler'].revalidate()
+        self._sync_value()
+        matching = set(fnmatch.filter(self.value, minion_id))
+        if not matching:
+            return
+        try:
+            self.option_dict['handler'].save([v for v in self.value if v not in matching])
+        finally:
+            self._sync_value()
 
     # pylint: disable=unused-argument
     def ui_complete_add(self, parameters, text, current_param):
@@ -712,6 +798,7 @@ class MinionsOptionNode(OptionNode):
         return matching
 
     def ui_complete_rm(self, parameters, text, current_param):
+        self._ensure_loaded()
         matching = []
         for minion in self.value:
             if minion.startswith(text):
@@ -738,10 +825,9 @@ def _generate_option_node(option_name, option_dict, parent):
 
 
 def _generate_group_node(group_name, group_dict, parent):
-    group_node = GroupNode(group_name, group_dict.get('help', ""), group_dict.get('handler', None),
-                           parent)
-    for option_name, option_dict in group_dict['options'].items():
-        _generate_option_node(option_name, option_dict, group_node)
+    # the option nodes are only generated when the group is first accessed
+    GroupNode(group_name, group_dict.get('help', ""), group_dict.get('handler', None), parent,
+              group_dict['options'])
 
 
 def generate_config_shell_tree(shell):
@@ -769,8 +855,26 @@ class SesBootConfigShell(configshell.ConfigShell):
         parser = Optional(path) + Optional(command) + Optional(parameters)
         self._parser = parser
 
+    def run_cmdline(self, cmdline):
+        # each command line is a single user action, and results in at most one
+        # pillar write and refresh
+        with PillarManager.transaction():
+            super(SesBootConfigShell, self).run_cmdline(cmdline)
+
+
+def show_job_progress(progress):
+    if progress.elapsed < PROGRESS_DELAY:
+        return
+    total = progress.total if progress.total is not None else '?'
+    counter = "{}: {}/{} minions returned".format(progress.fun, progress.done, total)
+    sys.stderr.write("\r" + counter)
+    if progress.finished:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
 
 def run_config_shell():
+    SaltJobs.progress = show_job_progress
     shell = SesBootConfigShell()
     generate_config_shell_tree(shell)
     while True:
@@ -783,6 +887,7 @@ def run_config_shell():
 
 
 def run_config_cmdline(cmdline):
+    SaltJobs.progress = show_job_progress
     shell = SesBootConfigShell()
     generate_config_shell_tree(shell)
     try:
@@ -792,3 +897,41 @@ def run_config_cmdline(cmdline):
     except Exception as ex:  # pylint: disable=broad-except
         logger.exception(ex)
         print("An error occurred: {}".format(ex))
+
+
+def run_config_script(script, stop_on_error=False, shell=None):
+    """
+    Runs the commands of a file object, one per line, in a single shell.
+    Grains and pillar are written, and the minions refreshed, once after the
+    last command. Empty lines and lines starting with '#' are ignored.
+    An existing shell can be reused, its tree is rebuilt so that nothing loaded
+    by a previous script is shown.
+    Returns the number of commands that failed.
+    """
+    if shell is None:
+        SaltJobs.progress = show_job_progress
+        shell = SesBootConfigShell()
+    generate_config_shell_tree(shell)
+    failed = 0
+    try:
+        with PillarManager.transaction(), SesNodeManager.transaction():
+            for lineno, line in enumerate(script, 1):
+                cmdline = line.strip()
+                if not cmdline or cmdline.startswith('#'):
+                    continue
+                try:
+                    logger.info("running command at line %s: %s", lineno, cmdline)
+                    shell.run_cmdline(cmdline)
+                except Exception as ex:  # pylint: disable=broad-except
+                    logger.exception(ex)
+                    print("Line {}: {}: An error occurred: {}".format(lineno, cmdline, ex))
+                    failed += 1
+                    if stop_on_error:
+                        break
+    except Exception as ex:  # pylint: disable=broad-except
+        logger.exception(ex)
+        print("An error occurred while saving the changes: {}".format(ex))
+        failed += 1
+    if not failed:
+        print("OK")
+    return failed
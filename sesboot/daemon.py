@@ -0,0 +1,154 @@
+"""
+Optional daemon that runs config shell commands sent over a local Unix socket,
+so that each command only pays for its own Salt work: the Salt clients, the
+pillar data and the SES inventory stay loaded between requests.
+"""
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from .exceptions import DaemonAlreadyRunningException, DaemonConnectionClosedException, \
+    DaemonNotRunningException
+from .inventory import InventorySnapshot
+from .model import SesNodeManager
+from .salt_utils import PillarManager, SaltJobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            response = ConfigDaemon.execute(json.loads(line.decode('utf-8')))
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.exception(ex)
+            response = {'error': str(ex)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ConfigDaemon:
+    """
+    Serves the requests of `sesboot config --daemon`, one at a time.
+    A request is a JSON line of the form {"commands": [...], "stop_on_error":
+    bool}, and is answered with a JSON line of the form {"output": str,
+    "failed": int}, or {"error": str}.
+    """
+    logger = logging.getLogger(__name__ + '.server')
+    socket_path = '/run/sesboot/sesboot.sock'
+    _lock = threading.Lock()
+    _shell = None
+    # inventory snapshot saved by the last request
+    _snapshot_stat = None
+
+    @classmethod
+    def _check_inventory(cls):
+        if not InventorySnapshot.enabled:
+            # nothing tells the daemon about changes made by other processes, the
+            # nodes are kept until '/Cluster refresh'
+            return
+        # every sesboot process saves the snapshot after changing the inventory,
+        # so the nodes kept in memory are only reused if nobody else saved it
+        stat = InventorySnapshot.stat()
+        if stat is None or stat != cls._snapshot_stat:
+            cls.logger.info("Inventory changed outside of the daemon, reloading it")
+            SesNodeManager.invalidate()
+
+    @classmethod
+    def execute(cls, request):
+        # pylint: disable=import-outside-toplevel
+        from .config_shell import SesBootConfigShell, run_config_script
+        with cls._lock:
+            cls._check_inventory()
+            if cls._shell is None:
+                cls._shell = SesBootConfigShell()
+            output = io.StringIO()
+            console = cls._shell.con
+            # the shell console keeps its own reference to stdout
+            stdout, console._stdout = console._stdout, output  # pylint: disable=protected-access
+            try:
+                with contextlib.redirect_stdout(output):
+                    failed = run_config_script(request['commands'],
+                                               request.get('stop_on_error', False),
+                                               shell=cls._shell)
+            finally:
+                console._stdout = stdout  # pylint: disable=protected-access
+                # the Salt clients are shared between requests, so the pillar journal is
+                # compacted here, under the lock, instead of by a later request
+                PillarManager.compact()
+            cls._snapshot_stat = InventorySnapshot.stat()
+        return {'output': output.getvalue(), 'failed': failed}
+
+    @classmethod
+    def _remove_stale_socket(cls):
+        if not os.path.exists(cls.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(cls.socket_path)
+            except OSError:
+                os.unlink(cls.socket_path)
+                return
+        raise DaemonAlreadyRunningException(cls.socket_path)
+
+    @classmethod
+    def create_server(cls):
+        """
+        Binds the socket, which only the current user can connect to
+        """
+        os.makedirs(os.path.dirname(cls.socket_path), mode=0o700, exist_ok=True)
+        cls._remove_stale_socket()
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(cls.socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        return server
+
+    @classmethod
+    def serve(cls):
+        server = cls.create_server()
+        # nobody watches the progress of the daemon jobs
+        SaltJobs.progress = None
+        PillarManager.journal_compaction_delay = None
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        cls.logger.info("Listening on %s", cls.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(cls.socket_path)
+            cls.logger.info("Stopped")
+
+
+def send_commands(commands, stop_on_error=False, socket_path=None):
+    """
+    Runs the commands in the sesboot daemon, and returns its response, see
+    `ConfigDaemon`
+    """
+    socket_path = socket_path if socket_path else ConfigDaemon.socket_path
+    request = {'commands': list(commands), 'stop_on_error': stop_on_error}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise DaemonNotRunningException(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as file:
+            line = file.readline()
+    if not line:
+        raise DaemonConnectionClosedException()
+    return json.loads(line.decode('utf-8'))
@@ -6,3 +6,36 @@ class SesNodeHasRolesException(SesBootException):
     def __init__(self, minion_id, roles):
         super(SesNodeHasRolesException, self).__init__(
             "Cannot remove host '{}' because it has roles defined: {}".format(minion_id, roles))
+
+
+class GrainsUpdateException(SesBootException):
+    def __init__(self, key, minions):
+        self.minions = minions
+        super(GrainsUpdateException, self).__init__(
+            "Failed to update grain '{}' in minions: {}".format(key, ", ".join(sorted(minions))))
+
+
+class DaemonAlreadyRunningException(SesBootException):
+    def __init__(self, socket_path):
+        super(DaemonAlreadyRunningException, self).__init__(
+            "sesboot daemon already running at {}".format(socket_path))
+
+
+class DaemonNotRunningException(SesBootException):
+    def __init__(self, socket_path):
+        super(DaemonNotRunningException, self).__init__(
+            "sesboot daemon is not running at {}".format(socket_path))
+
+
+class DaemonConnectionClosedException(SesBootException):
+    def __init__(self):
+        super(DaemonConnectionClosedException, self).__init__(
+            "sesboot daemon closed the connection")
+
+
+class SimulationProfileException(SesBootException):
+    def __init__(self, error, path=None):
+        self.error = error
+        super(SimulationProfileException, self).__init__(
+            "Invalid simulation profile{}: {}".format(" '{}'".format(path) if path else "",
+                                                      error))
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import time
+
+from .utils import atomic_write
+
+
+logger = logging.getLogger(__name__)
+
+
+class InventorySnapshot:
+    """
+    On-disk snapshot of the SES inventory: the SES nodes with their roles and
+    public IPs, and the candidate minions.
+    It lets a new sesboot process show the inventory without asking Salt, and
+    is always revalidated against Salt before the inventory is changed.
+    """
+    logger = logging.getLogger(__name__ + '.snapshot')
+    VERSION = 1
+    CACHE_DIR = '/var/cache/sesboot'
+    FILE = 'inventory.json'
+    enabled = True
+    # snapshots older than this many seconds are ignored
+    max_age = 24 * 60 * 60
+
+    @classmethod
+    def _path(cls):
+        return os.path.join(cls.CACHE_DIR, cls.FILE)
+
+    @classmethod
+    def load(cls):
+        """
+        Returns the snapshot as a dict with the 'nodes', 'minions' and 'saved_at'
+        keys, or None if there is no usable snapshot
+        """
+        if not cls.enabled:
+            return None
+        try:
+            with open(cls._path(), 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            cls.logger.warning("Ignoring unreadable inventory snapshot: %s", ex)
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != cls.VERSION:
+            cls.logger.info("Ignoring inventory snapshot with a different version")
+            return None
+        if time.time() - snapshot.get('saved_at', 0) > cls.max_age:
+            cls.logger.info("Ignoring inventory snapshot older than %ss", cls.max_age)
+            return None
+        cls.logger.info("Loaded inventory snapshot saved at %s", snapshot['saved_at'])
+        return snapshot
+
+    @classmethod
+    def stat(cls):
+        """
+        Returns a value that changes whenever the snapshot is saved, or None if
+        there is no snapshot
+        """
+        if not cls.enabled:
+            return None
+        try:
+            stat = os.stat(cls._path())
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    @classmethod
+    def save(cls, nodes, minions):
+        """
+        Stores the SES nodes, as {minion: {'roles': [...], 'public_ip': ip}}, and
+        the list of candidate minions
+        """
+        if not cls.enabled:
+            return
+        content = json.dumps({
+            'version': cls.VERSION,
+            'saved_at': time.time(),
+            'nodes': nodes,
+            'minions': sorted(minions)
+        }, sort_keys=True)
+        try:
+            atomic_write(cls._path(), content, mode=0o600)
+        except OSError as ex:
+            # the snapshot is only an optimization
+            cls.logger.warning("Failed to save inventory snapshot: %s", ex)
@@ -0,0 +1,123 @@
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Collects the number of calls and wall time of Salt jobs and pillar file
+    operations, and for Salt jobs the number of targeted and returning minions.
+    Nothing is collected unless `enabled` is set.
+    """
+    enabled = False
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, name, elapsed, targets=None, returned=None):
+        if not cls.enabled:
+            return
+        with cls._lock:
+            stat = cls._stats.setdefault(name, {'count': 0, 'time': 0.0, 'max': 0.0,
+                                                'targets': None, 'returned': None})
+            stat['count'] += 1
+            stat['time'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            if targets is not None:
+                stat['targets'] = (stat['targets'] or 0) + targets
+            if returned is not None:
+                stat['returned'] = (stat['returned'] or 0) + returned
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(name, time.perf_counter() - started)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {name: dict(stat) for name, stat in cls._stats.items()}
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stats = {}
+
+    @classmethod
+    def summary(cls):
+        """
+        Returns a table with the collected metrics, slowest operations first
+        """
+        stats = cls.stats()
+        lines = ["{:<40} {:>7} {:>10} {:>10} {:>8} {:>8}".format(
+            'operation', 'calls', 'total (s)', 'max (s)', 'targets', 'returns')]
+        for name, stat in sorted(stats.items(), key=lambda item: -item[1]['time']):
+            lines.append("{:<40} {:>7} {:>10.3f} {:>10.3f} {:>8} {:>8}".format(
+                name, stat['count'], stat['time'], stat['max'],
+                stat['targets'] if stat['targets'] is not None else '-',
+                stat['returned'] if stat['returned'] is not None else '-'))
+        return "\n".join(lines)
+
+
+def timed(name):
+    """
+    Decorator that records the calls of a function in Metrics
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Metrics.measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """
+    Profiles the whole sesboot command with cProfile and tracemalloc
+    """
+    # number of functions and allocation sites reported
+    LIMIT = 25
+    _profile = None
+
+    @classmethod
+    def start(cls):
+        # pylint: disable=import-outside-toplevel
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        cls._profile = cProfile.Profile()
+        cls._profile.enable()
+
+    @classmethod
+    def report(cls, out=None):
+        # pylint: disable=import-outside-toplevel
+        import pstats
+        import tracemalloc
+        if cls._profile is None:
+            return
+        out = out if out is not None else sys.stderr
+        cls._profile.disable()
+        # the memory snapshot is taken before the reports allocate anything
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        out.write("\nCPU profile (top {} by cumulative time)\n".format(cls.LIMIT))
+        pstats.Stats(cls._profile, stream=out).sort_stats('cumulative').print_stats(cls.LIMIT)
+        cls._profile = None
+
+        out.write("Memory: current={:.1f} KiB peak={:.1f} KiB, top {} allocation sites\n"
+                  .format(current / 1024, peak / 1024, cls.LIMIT))
+        for stat in snapshot.statistics('lineno')[:cls.LIMIT]:
+            out.write("{}\n".format(stat))
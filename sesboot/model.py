@@ -1,62 +1,248 @@
+import contextlib
 import logging
+import time
 
-from .exceptions import SesNodeHasRolesException
-from .salt_utils import SaltClient, GrainsManager, PillarManager
+from .exceptions import GrainsUpdateException, SesNodeHasRolesException
+from .inventory import InventorySnapshot
+from .salt_utils import GrainsManager, MinionDataCache, MinionKeysManager, PillarManager
 
 
 logger = logging.getLogger(__name__)
 
 
 SES_GRAIN_KEY = 'ses'
+PUBLIC_IP_GRAIN_KEY = 'fqdn_ip4'
 
 
 class SesNode:
-    def __init__(self, minion_id):
+    def __init__(self, minion_id, grains=None, cached_at=None):
+        """
+        Builds a SES node from the grains already retrieved for the minion.
+        It never calls Salt by itself, use `SesNodeManager` to build nodes
+        from live grains.
+        `cached_at` is the time the grains were cached by the master, if they
+        were not retrieved from the minion.
+        """
         self.minion_id = minion_id
         self.short_name = minion_id.split('.', 1)[0]
         self.roles = None
         self.public_ip = None
-        self._load()
+        self.cached_at = cached_at
+        self._load(grains if grains else {})
 
-    def _load(self):
-        result = GrainsManager.get_grain(self.minion_id, SES_GRAIN_KEY)
-        logger.info("Loading ses node '%s': result=%s", self.minion_id, result)
-        if result is None or self.minion_id not in result:
-            # not yet a ses node
-            self.roles = set()
-        elif not isinstance(result[self.minion_id], dict) or 'roles' not in result[self.minion_id]:
+    def _load(self, grains):
+        logger.info("Loading ses node '%s': grains=%s", self.minion_id, grains)
+        ses_grain = grains.get(SES_GRAIN_KEY)
+        if not isinstance(ses_grain, dict) or 'roles' not in ses_grain:
             # not yet a ses node
             self.roles = set()
         else:
-            self.roles = set(result[self.minion_id]['roles'])
+            self.roles = set(ses_grain['roles'])
+
+        ip_addrs = grains.get(PUBLIC_IP_GRAIN_KEY)
+        self.public_ip = ip_addrs[0] if ip_addrs else None
 
-        result = GrainsManager.get_grain(self.minion_id, 'fqdn_ip4')
-        self.public_ip = result[self.minion_id][0]
+    def cache_age(self):
+        """
+        Returns how many seconds old the grains of the node are, or None if
+        they were retrieved from the minion
+        """
+        if self.cached_at is None:
+            return None
+        return max(0, time.time() - self.cached_at)
 
     def add_role(self, role):
         self.roles.add(role)
 
+    def update(self, node):
+        """
+        Takes the roles, public IP and cache time of a reloaded copy of the node
+        """
+        self.roles = node.roles
+        self.public_ip = node.public_ip
+        self.cached_at = node.cached_at
+
     def _role_list(self):
-        return list(self.roles)
+        # sorted, so that nodes with the same roles have the same grain value
+        return sorted(self.roles)
 
-    def _grains_value(self):
+    def grains_value(self):
         return {
             'member': True,
             'roles': self._role_list()
         }
 
+    def snapshot_value(self):
+        return {
+            'roles': self._role_list(),
+            'public_ip': self.public_ip
+        }
+
+    @classmethod
+    def from_snapshot(cls, minion_id, value):
+        return cls(minion_id, {
+            SES_GRAIN_KEY: {'member': True, 'roles': value['roles']},
+            PUBLIC_IP_GRAIN_KEY: [value['public_ip']] if value['public_ip'] else []
+        })
+
     def save(self):
-        GrainsManager.set_grain(self.minion_id, SES_GRAIN_KEY, self._grains_value())
+        GrainsManager.set_grain(self.minion_id, SES_GRAIN_KEY, self.grains_value())
 
 
 class SesNodeManager:
+    # source of the SES membership: 'cache', the master minion data cache, or
+    # 'live', pinging the minions
+    membership = 'cache'
     _ses_nodes = {}
+    # time of the inventory snapshot the nodes were loaded from, None once the
+    # nodes were loaded or revalidated from Salt
+    _snapshot_time = None
+    _snapshot_minions = None
+    # Salt mine function (e.g. network.ip_addrs) whose first address is the
+    # public IP of a node, the PUBLIC_IP_GRAIN_KEY grain is used if not set
+    public_ip_mine_function = None
+    _transaction_depth = 0
+    # grain writes deferred by an ongoing transaction
+    _pending_nodes = {}
+    _pending_removals = set()
+    # incremented each time the nodes are reloaded, so that the config shell
+    # knows when to resync the minions it shows
+    _revision = 0
+
+    @classmethod
+    def _build_nodes(cls, minions, live=True):
+        """
+        Builds the SesNode objects of all minions from the master minion data
+        cache, unless `live` is set, and with a single Salt job for the minions
+        the master has no grains of
+        """
+        nodes = {}
+        cached = None if live else MinionDataCache.grains(minions)
+        if cached:
+            nodes = {minion: SesNode(minion, grains, updated)
+                     for minion, (grains, updated) in cached.items()}
+        missing = [minion for minion in minions if minion not in nodes]
+        # nodes are built as the minions answer, while the job waits for the slower ones
+        for minion, grains in GrainsManager.iter_grains(missing,
+                                                        [SES_GRAIN_KEY, PUBLIC_IP_GRAIN_KEY]):
+            nodes[minion] = SesNode(minion, grains)
+        nodes = {minion: nodes.get(minion) or SesNode(minion) for minion in minions}
+        cls._resolve_public_ips(nodes)
+        return nodes
+
+    @classmethod
+    def _resolve_public_ips(cls, nodes):
+        """
+        Sets the public IP of the nodes from the cached Salt mine data, if a
+        mine function is configured
+        """
+        if not cls.public_ip_mine_function or not nodes:
+            return
+        mine = MinionDataCache.mine(list(nodes), cls.public_ip_mine_function)
+        for minion, ret in (mine or {}).items():
+            ip_addrs = [ret] if isinstance(ret, str) else ret
+            if isinstance(ip_addrs, list) and ip_addrs:
+                nodes[minion].public_ip = ip_addrs[0]
 
     @classmethod
     def _load(cls):
         if not cls._ses_nodes:
+            snapshot = InventorySnapshot.load()
+            if snapshot is None:
+                cls.revalidate()
+                return
+            cls._set_nodes({minion: SesNode.from_snapshot(minion, value)
+                            for minion, value in snapshot['nodes'].items()})
+            cls._snapshot_minions = set(snapshot['minions'])
+            cls._snapshot_time = snapshot['saved_at']
+
+    @classmethod
+    def _set_nodes(cls, nodes):
+        """
+        Replaces the SES nodes, the nodes that are kept are updated in place so
+        that the config shell handlers holding them stay valid
+        """
+        for minion, node in nodes.items():
+            current = cls._ses_nodes.get(minion)
+            if current is not None:
+                current.update(node)
+                nodes[minion] = current
+        cls._ses_nodes = nodes
+        cls._revision += 1
+
+    @classmethod
+    def revision(cls):
+        return cls._revision
+
+    @classmethod
+    def _save_snapshot(cls):
+        InventorySnapshot.save({minion: node.snapshot_value()
+                                for minion, node in cls._ses_nodes.items()},
+                               MinionKeysManager.accepted_minions())
+
+    @classmethod
+    def _load_cached_nodes(cls):
+        """
+        Builds the SES nodes from the master minion data cache, without any Salt
+        job. Returns None if the master does not cache the minions data.
+        """
+        cached = GrainsManager.cached_grains(SES_GRAIN_KEY)
+        if cached is None:
+            return None
+        nodes = {minion: SesNode(minion, grains, updated)
+                 for minion, (grains, updated) in cached.items()}
+        cls._resolve_public_ips(nodes)
+        return nodes
+
+    @classmethod
+    def revalidate(cls, live=None):
+        """
+        Reloads the SES nodes from Salt, and updates the inventory snapshot.
+        The minions are only pinged if `live` is set, or the membership source
+        is 'live'.
+        """
+        if cls._pending_nodes or cls._pending_removals:
+            raise Exception("Cannot reload the SES nodes while they have unsaved changes")
+        if live is None:
+            live = cls.membership == 'live'
+        if live:
+            MinionDataCache.invalidate()
+        nodes = None if live else cls._load_cached_nodes()
+        if nodes is None:
             minions = GrainsManager.filter_by(SES_GRAIN_KEY)
-            cls._ses_nodes = {minion: SesNode(minion) for minion in minions}
+            nodes = cls._build_nodes(minions)
+        cls._set_nodes(nodes)
+        cls._snapshot_time = None
+        cls._snapshot_minions = None
+        cls._save_snapshot()
+
+    @classmethod
+    def invalidate(cls):
+        cls._ses_nodes = {}
+        cls._revision += 1
+        cls._snapshot_time = None
+        cls._snapshot_minions = None
+
+    @classmethod
+    def ensure_fresh(cls):
+        """
+        Revalidates the SES nodes if they were loaded from the inventory snapshot,
+        must be called before changing them
+        """
+        cls._load()
+        if cls._snapshot_time is not None:
+            logger.info("Revalidating inventory snapshot before changing it")
+            cls.revalidate()
+
+    @classmethod
+    def snapshot_age(cls):
+        """
+        Returns how many seconds old the inventory snapshot the nodes were loaded
+        from is, or None if the nodes are up to date with Salt
+        """
+        if cls._snapshot_time is None:
+            return None
+        return max(0, time.time() - cls._snapshot_time)
 
     @classmethod
     def save_in_pillar(cls):
@@ -64,41 +250,134 @@ class SesNodeManager:
         for node in cls._ses_nodes.values():
             if node.roles:
                 minions.append(node.short_name)
-        PillarManager.set('ses:minions:all', minions)
-        PillarManager.set('ses:minions:mon',
-                          {n.short_name: n.public_ip for n in cls._ses_nodes.values()
-                           if 'mon' in n.roles})
-        PillarManager.set('ses:minions:mgr',
-                          [n.short_name for n in cls._ses_nodes.values() if 'mgr' in n.roles])
+        with PillarManager.transaction():
+            PillarManager.set('ses:minions:all', minions)
+            PillarManager.set('ses:minions:mon',
+                              {n.short_name: n.public_ip for n in cls._ses_nodes.values()
+                               if 'mon' in n.roles})
+            PillarManager.set('ses:minions:mgr',
+                              [n.short_name for n in cls._ses_nodes.values() if 'mgr' in n.roles])
+
+            # choose the the main Mon
+            minions = [n.minion_id for n in cls._ses_nodes.values() if 'mon' in n.roles]
+            minions.sort()
+            if minions:  # i.e., it has at least one
+                PillarManager.set('ses:bootstrap_mon', minions[0])
+
+    @classmethod
+    def save_nodes(cls, nodes):
+        """
+        Saves the grains of several nodes at once, nodes with the same roles are
+        updated by a single Salt job
+        """
+        if not nodes:
+            return
+        if cls._transaction_depth > 0:
+            for node in nodes:
+                cls._pending_nodes[node.minion_id] = node
+                cls._pending_removals.discard(node.minion_id)
+            return
+        status = GrainsManager.set_grains(SES_GRAIN_KEY,
+                                          {node.minion_id: node.grains_value() for node in nodes})
+        failed = [minion for minion, success in status.items() if not success]
+        if failed:
+            logger.error("Failed to save ses nodes: %s", failed)
+            raise GrainsUpdateException(SES_GRAIN_KEY, failed)
+        cls._save_snapshot()
 
-        # choose the the main Mon
-        minions = [n.minion_id for n in cls._ses_nodes.values() if 'mon' in n.roles]
-        minions.sort()
-        if minions:  # i.e., it has at least one
-            PillarManager.set('ses:bootstrap_mon', minions[0])
+    @classmethod
+    def _flush(cls):
+        removals, cls._pending_removals = cls._pending_removals, set()
+        nodes, cls._pending_nodes = cls._pending_nodes, {}
+        if removals:
+            GrainsManager.del_grain(sorted(removals), SES_GRAIN_KEY)
+            GrainsManager.refresh_cache(sorted(removals))
+        try:
+            cls.save_nodes(list(nodes.values()))
+        except GrainsUpdateException:
+            # reload the roles the failed nodes still have, so that the pillar
+            # mirrors the grains
+            cls.revalidate(live=True)
+            cls.save_in_pillar()
+            raise
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Defers the grain writes of `save_nodes`, `add_nodes` and `remove_nodes`
+        done inside the context until the outermost transaction ends, when they
+        are written with one Salt job per distinct grain value.
+        The nodes are changed in memory right away, so they can be reloaded
+        only after the transaction.
+        """
+        cls._transaction_depth += 1
+        try:
+            yield
+        finally:
+            cls._transaction_depth -= 1
+            if cls._transaction_depth == 0:
+                cls._flush()
 
     @classmethod
     def ses_nodes(cls):
         cls._load()
         return cls._ses_nodes
 
+    @classmethod
+    def add_nodes(cls, minion_ids):
+        """
+        Makes the minions SES nodes, with a single pillar commit
+        """
+        cls.ensure_fresh()
+        nodes = cls._build_nodes(list(minion_ids), live=cls.membership == 'live')
+        try:
+            cls.save_nodes(list(nodes.values()))
+        except GrainsUpdateException as ex:
+            for minion_id in ex.minions:
+                del nodes[minion_id]
+            raise
+        finally:
+            cls._ses_nodes.update(nodes)
+            cls.save_in_pillar()
+            cls._save_snapshot()
+
     @classmethod
     def add_node(cls, minion_id):
-        cls._load()
-        node = SesNode(minion_id)
-        node.save()
-        cls._ses_nodes[minion_id] = node
+        cls.add_nodes([minion_id])
+
+    @classmethod
+    def remove_nodes(cls, minion_ids):
+        """
+        Removes the minions from the SES nodes, with a single pillar commit.
+        No node is removed if any of them still has roles.
+        """
+        cls.ensure_fresh()
+        minion_ids = list(minion_ids)
+        if not minion_ids:
+            return
+        for minion_id in minion_ids:
+            if cls._ses_nodes[minion_id].roles:
+                raise SesNodeHasRolesException(minion_id, cls._ses_nodes[minion_id].roles)
+        for minion_id in minion_ids:
+            del cls._ses_nodes[minion_id]
+        if cls._transaction_depth > 0:
+            for minion_id in minion_ids:
+                cls._pending_nodes.pop(minion_id, None)
+            cls._pending_removals.update(minion_ids)
+        else:
+            GrainsManager.del_grain(minion_ids, SES_GRAIN_KEY)
+            # the pillar refresh of the SES members no longer targets them
+            GrainsManager.refresh_cache(minion_ids)
         cls.save_in_pillar()
+        cls._save_snapshot()
 
     @classmethod
     def remove_node(cls, minion_id):
-        cls._load()
-        if cls._ses_nodes[minion_id].roles:
-            raise SesNodeHasRolesException(minion_id, cls._ses_nodes[minion_id].roles)
-        del cls._ses_nodes[minion_id]
-        GrainsManager.del_grain(minion_id, SES_GRAIN_KEY)
-        cls.save_in_pillar()
+        cls.remove_nodes([minion_id])
 
     @classmethod
     def list_all_minions(cls):
-        return SaltClient.caller().cmd('minion.list')['minions']
+        if cls._snapshot_minions is not None:
+            return set(cls._snapshot_minions)
+        return MinionKeysManager.accepted_minions()
@@ -0,0 +1,369 @@
+"""
+Local stand-in for the Salt master, used to exercise sesboot on large
+simulated clusters without any Salt infrastructure.
+It answers the execution modules used by sesboot, and models the publish
+latency of each job and the latency, lost returns and death of each minion.
+"""
+import fnmatch
+import json
+import logging
+import math
+import os
+import random
+import re
+import time
+
+import yaml
+
+from .exceptions import SimulationProfileException
+from .utils import atomic_write
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimulationProfile:
+    """
+    Describes the simulated cluster and how its minions behave.
+    Latencies are in seconds, jitters are the standard deviation of a normal
+    distribution around them, and drop_rate is the probability of a minion
+    return being lost.
+    """
+    DEFAULTS = {
+        'minions': 10,
+        'data_dir': '/tmp/sesboot-simulation',
+        'publish_latency': 0.0,
+        'publish_jitter': 0.0,
+        'minion_latency': 0.0,
+        'minion_jitter': 0.0,
+        'drop_rate': 0.0,
+        'timeout': 5.0,
+        'slow_minions': {},
+        'dead_minions': [],
+        'seed': None,
+    }
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.DEFAULTS)
+        if unknown:
+            raise SimulationProfileException(
+                "unknown settings: {}".format(", ".join(sorted(unknown))))
+        settings = dict(self.DEFAULTS, **kwargs)
+        minions = settings['minions']
+        if isinstance(minions, int):
+            minions = ['node{}.sim'.format(idx) for idx in range(minions)]
+        self.minions = list(minions)
+        self.data_dir = settings['data_dir']
+        self.publish_latency = settings['publish_latency']
+        self.publish_jitter = settings['publish_jitter']
+        self.minion_latency = settings['minion_latency']
+        self.minion_jitter = settings['minion_jitter']
+        self.drop_rate = settings['drop_rate']
+        self.timeout = settings['timeout']
+        self.slow_minions = dict(settings['slow_minions'])
+        self.dead_minions = set(settings['dead_minions'])
+        self.seed = settings['seed']
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r') as file:
+                settings = yaml.safe_load(file)
+        except (OSError, yaml.YAMLError) as ex:
+            raise SimulationProfileException(ex, path)
+        if settings is not None and not isinstance(settings, dict):
+            raise SimulationProfileException("settings must be a mapping", path)
+        try:
+            return cls(**(settings if settings else {}))
+        except SimulationProfileException as ex:
+            raise SimulationProfileException(ex.error, path)
+
+    def pillar_dir(self):
+        return os.path.join(self.data_dir, 'pillar')
+
+    def pki_dir(self):
+        return os.path.join(self.data_dir, 'pki')
+
+    def cache_dir(self):
+        return os.path.join(self.data_dir, 'cache')
+
+
+class CompoundTarget:
+    """
+    Evaluates the subset of the Salt compound matcher used by sesboot: glob,
+    G@ and L@ matchers combined with and, or, not and parentheses
+    """
+    def __init__(self, client, target):
+        self.client = client
+        self.tokens = re.sub(r'([()])', r' \1 ', target).split()
+        self.pos = 0
+
+    def _next(self):
+        token = self.tokens[self.pos] if self.pos < len(self.tokens) else None
+        self.pos += 1
+        return token
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def evaluate(self):
+        minions = self._or()
+        if self._peek() is not None:
+            raise Exception("Invalid compound target near '{}'".format(self._peek()))
+        return minions
+
+    def _or(self):
+        minions = self._and()
+        while self._peek() == 'or':
+            self._next()
+            minions = minions | self._and()
+        return minions
+
+    def _and(self):
+        minions = self._not()
+        while self._peek() == 'and':
+            self._next()
+            minions = minions & self._not()
+        return minions
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._next()
+            return set(self.client.minions) - self._not()
+        return self._atom()
+
+    def _atom(self):
+        token = self._next()
+        if token is None:
+            raise Exception("Unexpected end of compound target")
+        if token == '(':
+            minions = self._or()
+            if self._next() != ')':
+                raise Exception("Unbalanced parentheses in compound target")
+            return minions
+        if token.startswith('G@'):
+            return self.client.match_grain(token[2:])
+        if token.startswith('L@'):
+            return self.client.match_list(token[2:].split(','))
+        if '@' in token:
+            raise Exception("Unsupported compound matcher '{}'".format(token))
+        return self.client.match_glob(token)
+
+
+class SimulatedMinionCache:
+    """
+    Replaces the master minion data cache, with the grains of the simulated
+    minions, including the dead ones
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def fetch(self, bank, key):
+        minion = bank.split('/', 1)[1]
+        if key != 'data' or minion not in self.client.cached_at:
+            return {}
+        return {'grains': self.client.grains(minion)}
+
+    def updated(self, bank, key):
+        return self.client.cached_at.get(bank.split('/', 1)[1]) if key == 'data' else None
+
+
+class SimulatedLocalClient:
+    """
+    Replaces salt.client.LocalClient.
+    Grains are kept in memory, indexed by their "key:value" entries, and stored
+    in the data directory so they persist across sesboot runs.
+    """
+    logger = logging.getLogger(__name__ + '.local')
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.minions = list(profile.minions)
+        self._minion_set = set(self.minions)
+        self.jobs = []
+        self._rng = random.Random(profile.seed)
+        self._jid = 0
+        self._grains = {}
+        self.cached_at = {}
+        self._entries = {}
+        self._index = {}
+        self._setup()
+
+    def _grains_path(self):
+        return os.path.join(self.profile.data_dir, 'grains.json')
+
+    def _setup(self):
+        keys_dir = os.path.join(self.profile.pki_dir(), 'minions')
+        os.makedirs(keys_dir, exist_ok=True)
+        os.makedirs(self.profile.pillar_dir(), exist_ok=True)
+        for minion in set(self.minions) - set(os.listdir(keys_dir)):
+            open(os.path.join(keys_dir, minion), 'w').close()
+
+        grains = {}
+        if os.path.exists(self._grains_path()):
+            with open(self._grains_path(), 'r') as file:
+                grains = json.load(file)
+        for idx, minion in enumerate(self.minions):
+            minion_grains = grains.get(minion)
+            if minion_grains is None:
+                minion_grains = {'id': minion, 'fqdn_ip4': ['10.{}.{}.{}'.format(
+                    idx // 65536, (idx // 256) % 256, idx % 256)]}
+            self._set_grains(minion, minion_grains)
+
+    def _save_grains(self):
+        atomic_write(self._grains_path(), json.dumps(self._grains))
+
+    @classmethod
+    def _enumerate_entries(cls, grains):
+        entries = set()
+        for key, val in grains.items():
+            if isinstance(val, dict):
+                entries.update("{}:{}".format(key, e) for e in cls._enumerate_entries(val))
+            elif isinstance(val, list):
+                entries.update("{}:{}".format(key, e) for e in val)
+            else:
+                entries.add("{}:{}".format(key, val))
+        return entries
+
+    def _set_grains(self, minion, grains):
+        for entry in self._entries.get(minion, ()):
+            self._index[entry].discard(minion)
+            if not self._index[entry]:
+                del self._index[entry]
+        self._grains[minion] = grains
+        self.cached_at[minion] = int(time.time())
+        self._entries[minion] = self._enumerate_entries(grains)
+        for entry in self._entries[minion]:
+            self._index.setdefault(entry, set()).add(minion)
+
+    def match_grain(self, pattern):
+        if not any(char in pattern for char in '*?['):
+            return set(self._index.get(pattern, ()))
+        minions = set()
+        for entry in fnmatch.filter(self._index, pattern):
+            minions.update(self._index[entry])
+        return minions
+
+    def grains(self, minion):
+        return dict(self._grains[minion])
+
+    def cache(self):
+        return SimulatedMinionCache(self)
+
+    def match_list(self, minions):
+        return set(minions) & self._minion_set
+
+    def match_glob(self, pattern):
+        return set(fnmatch.filter(self.minions, pattern))
+
+    def _target(self, tgt, tgt_type):
+        if tgt_type == 'list':
+            return self.match_list(tgt)
+        if tgt_type == 'grain':
+            return self.match_grain(tgt)
+        if tgt_type == 'compound':
+            return CompoundTarget(self, tgt).evaluate()
+        if tgt_type == 'glob':
+            return self.match_glob(tgt)
+        raise Exception("Unsupported target type '{}'".format(tgt_type))
+
+    def _execute(self, minion, fun, arg):
+        grains = self._grains[minion]
+        if fun == 'grains.setval':
+            grains = dict(grains, **{arg[0]: arg[1]})
+            self._set_grains(minion, grains)
+            return {arg[0]: arg[1]}
+        if fun == 'grains.delkey':
+            grains = {key: val for key, val in grains.items() if key != arg[0]}
+            self._set_grains(minion, grains)
+            return {'comment': '', 'result': True}
+        if fun == 'grains.get':
+            return grains.get(arg[0], '')
+        if fun == 'grains.item':
+            return {key: grains.get(key, '') for key in arg}
+        if fun in ('test.ping', 'saltutil.pillar_refresh'):
+            return True
+        return "'{}' is not available.".format(fun)
+
+    def _sample(self, latency, jitter):
+        if not jitter:
+            return latency
+        return max(0.0, self._rng.gauss(latency, jitter))
+
+    @staticmethod
+    def _sleep_until(deadline):
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _returns(self, minions, fun, arg, timeout):
+        """
+        Yields the (minion, return) tuples in arrival order, as late as the
+        simulated latencies say
+        """
+        profile = self.profile
+        timeout = timeout if timeout is not None else profile.timeout
+        publish_latency = self._sample(profile.publish_latency, profile.publish_jitter)
+        self._sleep_until(time.monotonic() + publish_latency)
+        published = time.monotonic()
+
+        arrivals = []
+        incomplete = False
+        for minion in sorted(minions):
+            if minion in profile.dead_minions:
+                incomplete = True
+                continue
+            latency = self._sample(profile.minion_latency + profile.slow_minions.get(minion, 0),
+                                   profile.minion_jitter)
+            # a lost return still runs the function in the minion
+            lost = self._rng.random() < profile.drop_rate
+            if lost or latency > timeout:
+                incomplete = True
+            arrivals.append((latency, lost or latency > timeout, minion))
+        arrivals.sort()
+
+        for latency, lost, minion in arrivals:
+            self._sleep_until(published + min(latency, timeout))
+            ret = self._execute(minion, fun, arg)
+            if not lost:
+                yield minion, ret
+        if fun in ('grains.setval', 'grains.delkey'):
+            self._save_grains()
+        if incomplete:
+            # Salt waits for the missing minions until the job times out
+            self._sleep_until(published + timeout)
+
+    def _publish(self, tgt, fun, tgt_type):
+        self._jid += 1
+        self.jobs.append((tgt, fun, tgt_type))
+        self.logger.debug("Job %s: %s on %s (%s)", self._jid, fun, tgt, tgt_type)
+        return "{:020d}".format(self._jid)
+
+    # pylint: disable=unused-argument,too-many-arguments
+    def cmd_iter(self, tgt, fun, arg=(), timeout=None, tgt_type='glob', ret='', kwarg=None,
+                 yield_pub_data=False, **kwargs):
+        minions = self._target(tgt, tgt_type)
+        jid = self._publish(tgt, fun, tgt_type)
+        if yield_pub_data:
+            yield {'jid': jid, 'minions': sorted(minions)}
+        for minion, data in self._returns(minions, fun, list(arg), timeout):
+            yield {minion: {'ret': data, 'retcode': 0}}
+
+    def cmd_batch(self, tgt, fun, arg=(), tgt_type='glob', ret='', kwarg=None, batch='10%',
+                  **kwargs):
+        minions = sorted(self._target(tgt, tgt_type))
+        if str(batch).endswith('%'):
+            size = max(1, int(math.ceil(len(minions) * float(batch[:-1]) / 100)))
+        else:
+            size = int(batch)
+        for idx in range(0, len(minions), size):
+            chunk = minions[idx:idx + size]
+            self._publish(chunk, fun, 'list')
+            for minion, data in self._returns(chunk, fun, list(arg), kwargs.get('timeout')):
+                yield {minion: data}
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, tgt_type='glob', ret='', jid='', kwarg=None,
+            **kwargs):
+        minions = self._target(tgt, tgt_type)
+        self._publish(tgt, fun, tgt_type)
+        return dict(self._returns(minions, fun, list(arg), timeout))
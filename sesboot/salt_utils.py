@@ -1,28 +1,42 @@
+import atexit
+import collections
+import contextlib
+import json
 import logging
 import os
+import threading
+import time
 import yaml
 
-import salt.client
-import salt.minion
+from .metrics import Metrics, timed
+from .serializers import YamlSerializer, serializer_for
+from .utils import atomic_write, fsync_dir
 
 
 logger = logging.getLogger(__name__)
 
 
 class SaltClient:
+    MASTER_CONFIG = '/etc/salt/master'
+    # SimulationProfile of the simulated cluster that replaces the Salt master
+    simulation = None
     _OPTS_ = None
     _CALLER_ = None
     _LOCAL_ = None
-    _MASTER_ = None
+    _CACHE_ = None
 
     @classmethod
     def _opts(cls):
         """
-        Initializes and retrieves the Salt opts structure
+        Initializes and retrieves the Salt opts structure.
+        The master config is parsed only once and shared by all clients.
         """
         if cls._OPTS_ is None:
+            # salt modules are slow to import, and not needed by every sesboot command
+            import salt.config  # pylint: disable=import-outside-toplevel
             logger.info("Initializing SaltClient with master config")
-            cls._OPTS_ = salt.config.master_config('/etc/salt/master')
+            with Metrics.measure('salt.init:master_config'):
+                cls._OPTS_ = salt.config.master_config(cls.MASTER_CONFIG)
             # pylint: disable=unsupported-assignment-operation
             cls._OPTS_['file_client'] = 'local'
             logger.debug("SaltClient __opts__ = %s", cls._OPTS_)
@@ -35,7 +49,12 @@ class SaltClient:
         Initializes and retrieves the Salt caller client instance
         """
         if cls._CALLER_ is None:
-            cls._CALLER_ = salt.client.Caller(mopts=cls._opts())
+            if cls.simulation is not None:
+                raise Exception("Salt caller is not available with the simulated Salt backend")
+            import salt.client  # pylint: disable=import-outside-toplevel
+            opts = cls._opts()
+            with Metrics.measure('salt.init:caller'):
+                cls._CALLER_ = salt.client.Caller(mopts=opts)
         return cls._CALLER_
 
     @classmethod
@@ -43,21 +62,253 @@ class SaltClient:
         """
         Initializes and retrieves the Salt local client instance
         """
+        if cls._LOCAL_ is None and cls.simulation is not None:
+            from .salt_sim import SimulatedLocalClient  # pylint: disable=import-outside-toplevel
+            cls._LOCAL_ = SimulatedLocalClient(cls.simulation)
         if cls._LOCAL_ is None:
-            cls._LOCAL_ = salt.client.LocalClient()
+            import salt.client  # pylint: disable=import-outside-toplevel
+            opts = cls._opts()
+            with Metrics.measure('salt.init:local'):
+                cls._LOCAL_ = salt.client.LocalClient(mopts=opts)
         return cls._LOCAL_
 
     @classmethod
-    def master(cls):
-        if cls._MASTER_ is None:
-            _opts = salt.config.master_config('/etc/salt/master')
-            _opts['file_client'] = 'local'
-            cls._MASTER_ = salt.minion.MasterMinion(_opts)
-        return cls._MASTER_
+    def cache(cls):
+        """
+        Initializes and retrieves the master minion data cache, or returns None
+        if the master does not cache the minions data
+        """
+        if cls.simulation is not None:
+            # bound to the current simulated client, which may be replaced
+            return cls.local().cache()
+        if cls._CACHE_ is None:
+            if cls._opts().get('minion_data_cache', True):  # pylint: disable=no-member
+                import salt.cache  # pylint: disable=import-outside-toplevel
+                cls._CACHE_ = salt.cache.factory(cls._opts())
+        return cls._CACHE_
 
     @classmethod
     def pillar_fs_path(cls):
-        return cls.master().opts['pillar_roots']['base'][0]
+        if cls.simulation is not None:
+            return cls.simulation.pillar_dir()
+        # pylint: disable=unsubscriptable-object
+        return cls._opts()['pillar_roots']['base'][0]
+
+    @classmethod
+    def pki_dir(cls):
+        if cls.simulation is not None:
+            # the simulated cluster creates the keys of its minions
+            cls.local()
+            return cls.simulation.pki_dir()
+        return cls._opts()['pki_dir']  # pylint: disable=unsubscriptable-object
+
+
+class MinionKeysManager:
+    """
+    Lists the minions whose keys were accepted by the master, straight from the
+    master PKI directory.
+    The list is cached while the directory mtime does not change, and at most
+    `ttl` seconds in case the filesystem mtime granularity hides a change.
+    """
+    logger = logging.getLogger(__name__ + '.keys')
+    ttl = 60
+    _minions = None
+    _mtime = None
+    _loaded_at = 0
+
+    @classmethod
+    def _keys_dir(cls):
+        return os.path.join(SaltClient.pki_dir(), 'minions')
+
+    @classmethod
+    def accepted_minions(cls):
+        keys_dir = cls._keys_dir()
+        try:
+            mtime = os.stat(keys_dir).st_mtime_ns
+        except OSError as ex:
+            cls.logger.info("Cannot access minion keys directory, asking Salt: %s", ex)
+            caller = SaltClient.caller()
+            with Metrics.measure('salt.call:minion.list'):
+                return set(caller.cmd('minion.list')['minions'])
+
+        now = time.monotonic()
+        if cls._minions is None or mtime != cls._mtime or now - cls._loaded_at > cls.ttl:
+            with Metrics.measure('minion_keys.list'):
+                cls._minions = {name for name in os.listdir(keys_dir)
+                                if not name.startswith('.')}
+            cls._mtime = mtime
+            cls._loaded_at = now
+            cls.logger.info("Loaded %s accepted minion keys from %s", len(cls._minions),
+                            keys_dir)
+        return set(cls._minions)
+
+    @classmethod
+    def invalidate(cls):
+        cls._minions = None
+
+
+class MinionDataCache:
+    """
+    Reads the grains and Salt mine data the master caches for each minion,
+    without publishing any Salt job.
+    The decoded entries are kept in memory until the master updates them, which
+    it does when the minion starts, refreshes its grains or pillar, or updates
+    its mine. Entries updated in the last `granularity` seconds are always read
+    again, as the cache timestamps may hide a newer update.
+    """
+    logger = logging.getLogger(__name__ + '.cache')
+    granularity = 1
+    _entries = {}
+
+    @classmethod
+    def _fetch(cls, cache, minion, key):
+        """
+        Returns a (data, updated) tuple, data is None if the minion has no entry
+        """
+        bank = 'minions/{}'.format(minion)
+        updated = cache.updated(bank, key)
+        if updated is None:
+            cls._entries.pop((minion, key), None)
+            return None, None
+        entry = cls._entries.get((minion, key))
+        if entry is not None and entry[0] == updated:
+            return entry[1], updated
+        data = cache.fetch(bank, key)
+        if time.time() - updated > cls.granularity:
+            cls._entries[(minion, key)] = (updated, data)
+        return data, updated
+
+    @classmethod
+    @timed('minion_cache.grains')
+    def grains(cls, minions):
+        """
+        Returns a dict of the form {minion: (grains, updated)} of the minions
+        with cached grains, or None if the master has no cache
+        """
+        cache = SaltClient.cache()
+        if cache is None:
+            return None
+        result = {}
+        for minion in minions:
+            data, updated = cls._fetch(cache, minion, 'data')
+            if data and data.get('grains'):
+                result[minion] = (data['grains'], updated)
+        return result
+
+    @classmethod
+    @timed('minion_cache.mine')
+    def mine(cls, minions, function):
+        """
+        Returns a dict of the form {minion: return} with the last return of the
+        Salt mine function of each minion that has one, or None if the master
+        has no cache
+        """
+        cache = SaltClient.cache()
+        if cache is None:
+            return None
+        result = {}
+        for minion in minions:
+            data, _ = cls._fetch(cache, minion, 'mine')
+            if data and function in data:
+                result[minion] = data[function]
+        cls.logger.info("Found %s mine data of %s minions", function, len(result))
+        return result
+
+    @classmethod
+    def invalidate(cls):
+        cls._entries = {}
+
+
+JobProgress = collections.namedtuple('JobProgress',
+                                     ['fun', 'done', 'total', 'elapsed', 'finished'])
+
+
+class SaltJobs:
+    """
+    Runs Salt jobs through the streaming LocalClient API, so the return of each
+    minion is available as soon as it arrives, instead of only after the
+    slowest minion answers or times out.
+    `progress`, when set, is called with a JobProgress after each return.
+    Operations of a class listed in `batch_sizes` run in Salt batch mode, on a
+    fixed count ("10") or percentage ("25%") of the targets at a time.
+    """
+    GRAINS_WRITE = 'grains_write'
+    PILLAR_REFRESH = 'pillar_refresh'
+
+    logger = logging.getLogger(__name__ + '.jobs')
+    progress = None
+    timeout = None
+    batch_sizes = {}
+
+    @classmethod
+    def _report(cls, fun, done, total, started, finished=False):
+        if cls.progress is not None:
+            # pylint: disable=not-callable
+            cls.progress(JobProgress(fun, done, total, time.monotonic() - started, finished))
+
+    @classmethod
+    def _returns(cls, target, fun, arg, tgt_type, batch):
+        """
+        Yields the number of expected minion returns, if known, followed by
+        (minion, return) tuples
+        """
+        local = SaltClient.local()
+        if batch:
+            # the batch gathers the targeted minions itself
+            yield len(target) if tgt_type == 'list' else None
+            for ret in local.cmd_batch(target, fun, arg, tgt_type=tgt_type, batch=batch):
+                yield from ret.items()
+            return
+
+        returns = local.cmd_iter(target, fun, arg, tgt_type=tgt_type, timeout=cls.timeout,
+                                 yield_pub_data=True)
+        pub_data = next(returns, None)
+        if not pub_data:
+            cls.logger.error("Failed to publish %s job to %s", fun, target)
+            return
+        cls.logger.debug("Published job %s", pub_data['jid'])
+        yield len(pub_data['minions'])
+        for ret in returns:
+            for minion, data in ret.items():
+                yield minion, data.get('ret')
+
+    @classmethod
+    def stream(cls, target, fun, arg=None, tgt_type='glob', operation=None):
+        """
+        Publishes a Salt job and yields a (minion, return) tuple per minion as
+        the returns arrive
+        """
+        started = time.monotonic()
+        batch = cls.batch_sizes.get(operation)
+        cls.logger.debug("Running %s%s on %s%s", fun, arg if arg else '', target,
+                         " in batches of {}".format(batch) if batch else "")
+        returns = cls._returns(target, fun, arg if arg else [], tgt_type, batch)
+        try:
+            total = next(returns)
+        except StopIteration:
+            Metrics.record('salt.job:{}'.format(fun), time.monotonic() - started, returned=0)
+            return
+        done = 0
+        cls._report(fun, done, total, started)
+        try:
+            for minion, ret in returns:
+                done += 1
+                cls._report(fun, done, total, started)
+                yield minion, ret
+        finally:
+            elapsed = time.monotonic() - started
+            cls.logger.info("Job %s: %s/%s minions returned in %.2fs", fun, done,
+                            total if total is not None else '?', elapsed)
+            Metrics.record('salt.job:{}'.format(fun), elapsed, targets=total, returned=done)
+            cls._report(fun, done, total, started, finished=True)
+
+    @classmethod
+    def run(cls, target, fun, arg=None, tgt_type='glob', operation=None):
+        """
+        Runs a Salt job to completion, returns a dict of the form {minion: return}
+        aggregating the returns of all batches
+        """
+        return dict(cls.stream(target, fun, arg, tgt_type, operation))
 
 
 class GrainsManager:
@@ -73,38 +324,176 @@ class GrainsManager:
         return target, tgt_type
 
     @classmethod
+    @timed('grains.set_grain')
     def set_grain(cls, target, key, val):
         target, tgt_type = cls._format_target(target)
         cls.logger.debug("Adding '%s = %s' grain to %s", key, val, target)
-        result = SaltClient.local().cmd(target, 'grains.setval', [key, val], tgt_type=tgt_type)
+        result = SaltJobs.run(target, 'grains.setval', [key, val], tgt_type=tgt_type,
+                              operation=SaltJobs.GRAINS_WRITE)
         cls.logger.info("Added '%s = %s' grain to %s: result=%s", key, val, target, result)
 
     @classmethod
+    @timed('grains.set_grains')
+    def set_grains(cls, key, values):
+        """
+        Sets the grain key of each minion to its own value, with one list-targeted
+        Salt job per distinct value.
+        Returns a dict of the form {minion: success}.
+        """
+        groups = {}
+        for minion, val in values.items():
+            group_key = json.dumps(val, sort_keys=True)
+            groups.setdefault(group_key, (val, []))[1].append(minion)
+
+        status = {}
+        for val, minions in groups.values():
+            cls.logger.debug("Adding '%s = %s' grain to %s", key, val, minions)
+            status.update(dict.fromkeys(minions, False))
+            for minion, ret in SaltJobs.stream(minions, 'grains.setval', [key, val],
+                                               tgt_type='list', operation=SaltJobs.GRAINS_WRITE):
+                # grains.setval returns the new grains dict when it succeeds
+                status[minion] = isinstance(ret, dict)
+            cls.logger.info("Added '%s = %s' grain to %s: status=%s", key, val, minions,
+                            {minion: status[minion] for minion in minions})
+        return status
+
+    @classmethod
+    @timed('grains.del_grain')
     def del_grain(cls, target, key):
         target, tgt_type = cls._format_target(target)
         cls.logger.debug("Deleting '%s' grain from %s", key, target)
-        result = SaltClient.local().cmd(target, 'grains.delkey', [key], tgt_type=tgt_type)
+        result = SaltJobs.run(target, 'grains.delkey', [key], tgt_type=tgt_type,
+                              operation=SaltJobs.GRAINS_WRITE)
         cls.logger.info("Deleted '%s' grain from %s: result=%s", key, target, result)
 
     @classmethod
+    @timed('grains.refresh_cache')
+    def refresh_cache(cls, minions):
+        """
+        Refreshes the pillar of the minions, which makes them send their grains
+        to the master minion data cache. Needed after grain changes that do not
+        refresh it by themselves, like grains.delkey in older Salt versions.
+        """
+        if not minions:
+            return
+        cls.logger.debug("Refreshing the cached grains of %s", minions)
+        SaltJobs.run(list(minions), 'saltutil.pillar_refresh', tgt_type='list',
+                     operation=SaltJobs.PILLAR_REFRESH)
+
+    @classmethod
+    @timed('grains.filter_by')
     def filter_by(cls, key, val=None):
-        result = SaltClient.local().cmd('{}:{}'.format(key, val if val else '*'), 'test.ping',
-                                        tgt_type='grain')
+        result = SaltJobs.run('{}:{}'.format(key, val if val else '*'), 'test.ping',
+                              tgt_type='grain')
         return list(result)
 
     @classmethod
+    @timed('grains.cached_grains')
+    def cached_grains(cls, key, val=None):
+        """
+        Finds the accepted minions whose grains match in the master minion data
+        cache, without publishing any Salt job, so minions that are down are
+        found as well.
+        Returns a dict of the form {minion: (grains, updated)}, where updated is
+        the time the grains were cached, or None if the master has no cache.
+        """
+        # pylint: disable=import-outside-toplevel
+        import salt.utils.data
+        cached = MinionDataCache.grains(MinionKeysManager.accepted_minions())
+        if cached is None:
+            return None
+        expr = '{}:{}'.format(key, val if val else '*')
+        result = {minion: (grains, updated) for minion, (grains, updated) in cached.items()
+                  if salt.utils.data.subdict_match(grains, expr)}
+        cls.logger.info("Found %s minions matching %s in the minion data cache", len(result),
+                        expr)
+        return result
+
+    @classmethod
+    @timed('grains.get_grain')
     def get_grain(cls, target, key):
         target, tgt_type = cls._format_target(target)
         cls.logger.debug("Getting '%s' grain from %s", key, target)
-        result = SaltClient.local().cmd(target, 'grains.get', [key], tgt_type=tgt_type)
+        result = SaltJobs.run(target, 'grains.get', [key], tgt_type=tgt_type)
         cls.logger.info("Got '%s' grain from %s: result=%s", key, target, result)
         return result
 
+    @classmethod
+    def iter_grains(cls, target, keys):
+        """
+        Retrieves several grains from all targeted minions in a single Salt job.
+        Yields a (minion, {key: value}) tuple per minion as soon as it answers.
+        """
+        target, tgt_type = cls._format_target(target)
+        if tgt_type == 'list' and not target:
+            return
+        cls.logger.debug("Getting %s grains from %s", keys, target)
+        yield from SaltJobs.stream(target, 'grains.item', list(keys), tgt_type=tgt_type)
+
+    @classmethod
+    @timed('grains.get_grains')
+    def get_grains(cls, target, keys):
+        """
+        Returns a dict of the form {minion: {key: value}}, see `iter_grains`
+        """
+        result = dict(cls.iter_grains(target, keys))
+        cls.logger.info("Got %s grains from %s: result=%s", keys, target, result)
+        return result
+
 
 class PillarManager:
     PILLAR_FILE = "ses.sls"
+    TOP_FILE = "top.sls"
+    JOURNAL_FILE = ".ses.journal"
     pillar_data = {}
     logger = logging.getLogger(__name__ + '.pillar')
+    # compound target (may include nodegroups) of the minions refreshed after a change
+    refresh_target = 'G@ses:member:True'
+    # when enabled, only the minions whose top file entries include the changed
+    # pillar file are refreshed
+    refresh_affected_only = False
+    _transaction_depth = 0
+    _pending_keys = frozenset()
+    # serializer used to write the pillar files, None keeps the format of the
+    # pillar file found on disk (YAML for a new pillar). Files are read in any format.
+    serializer = None
+    # serializer of each pillar file read
+    _file_serializers = {}
+    # when enabled, each '<root>:<subtree>' key is stored in its own '<root>/<subtree>.sls'
+    # shard, and PILLAR_FILE only includes the shards. True or False convert the
+    # pillar to that layout, None keeps the layout found on disk.
+    sharded = None
+    # stat of each file whose content is loaded in pillar_data, the cached data
+    # is valid while the files stat do not change
+    _file_stats = {}
+    # SLS names of the shards included by PILLAR_FILE, None if it is not sharded
+    _shards = None
+    _pillar_base_path = None
+    # when enabled, commits only append the changes to the journal file, and a
+    # deferred compaction writes them to the pillar files and refreshes the minions.
+    # The compaction runs at the end of the first commit that comes this many
+    # seconds after the oldest journaled change, or at exit (None leaves it to
+    # the caller, e.g. the daemon after each request).
+    journal = False
+    journal_compaction_delay = 5
+    _journal_keys = frozenset()
+    # time of the oldest journaled change that was not compacted yet
+    _journal_started = None
+    _atexit_registered = False
+    _lock = threading.RLock()
+
+    _COMPOUND_PREFIXES = {
+        'glob': '',
+        'grain': 'G@',
+        'grain_pcre': 'P@',
+        'list': 'L@',
+        'pcre': 'E@',
+        'pillar': 'I@',
+        'pillar_pcre': 'J@',
+        'ipcidr': 'S@',
+        'nodegroup': 'N@',
+        'range': 'R@',
+    }
 
     @staticmethod
     def _get_dict_value(dict_, key_path):
@@ -150,40 +539,398 @@ class PillarManager:
         cls._del_dict_key(dict_, ":".join(path[:-1]))
 
     @classmethod
-    def _load_yaml(cls, custom_file):
-        pillar_base_path = SaltClient.pillar_fs_path()
-        full_path = "{}/{}".format(pillar_base_path, custom_file)
+    def _pillar_path(cls, custom_file):
+        if cls._pillar_base_path is None:
+            cls._pillar_base_path = SaltClient.pillar_fs_path()
+        return "{}/{}".format(cls._pillar_base_path, custom_file)
+
+    @staticmethod
+    def _file_stat(full_path):
+        """
+        Returns the file attributes that change whenever a file is modified or
+        replaced, or None if the file does not exist
+        """
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def _load_file(cls, custom_file):
+        full_path = cls._pillar_path(custom_file)
         cls.logger.info("Reading pillar items from file: %s", full_path)
         if not os.path.exists(full_path):
             return {}
-        with open(full_path, 'r') as file:
-            data = yaml.load(file)
-            if data is None:
-                data = {}
+        with Metrics.measure('pillar.file:read'):
+            with open(full_path, 'r') as file:
+                content = file.read()
+        serializer = serializer_for(content)
+        cls._file_serializers[custom_file] = serializer
+        with Metrics.measure('pillar.file:parse'):
+            data = serializer.load(content)
+        if data is None:
+            data = {}
         return data
 
+    @classmethod
+    def _save_file(cls, data, custom_file):
+        # new shards are written in the format of the pillar file
+        serializer = cls.serializer or cls._file_serializers.get(custom_file) or \
+            cls._file_serializers.get(cls.PILLAR_FILE, YamlSerializer)
+        cls._file_serializers[custom_file] = serializer
+        with Metrics.measure('pillar.file:serialize'):
+            content = serializer.dump(data)
+        with Metrics.measure('pillar.file:write'):
+            atomic_write(cls._pillar_path(custom_file), content)
+
+    @classmethod
+    def _is_sharded(cls):
+        """
+        Returns whether the pillar is written as shards, the pillar files must be
+        loaded already
+        """
+        if cls.sharded is not None:
+            return cls.sharded
+        return cls._shards is not None
+
     @staticmethod
-    def _save_yaml(data, custom_file):
-        pillar_base_path = SaltClient.pillar_fs_path()
-        full_path = "{}/{}".format(pillar_base_path, custom_file)
-        with open(full_path, 'w') as file:
-            content = yaml.dump(data, default_flow_style=False)
-            if content == '{}\n':
-                file.write("")
+    def _shard_name(key):
+        """
+        Returns the SLS name of the shard that stores the pillar key
+        """
+        path = key.split(":")
+        if len(path) < 2:
+            return None
+        return "{}.{}".format(path[0], path[1])
+
+    @staticmethod
+    def _shard_file(shard):
+        return "{}.sls".format(shard.replace(".", "/"))
+
+    @classmethod
+    def _key_shards(cls, key):
+        """
+        Returns the included shards that store the pillar key, or all of them if
+        key is None
+        """
+        # pylint: disable=not-an-iterable,unsupported-membership-test
+        if key is None:
+            return list(cls._shards)
+        shard = cls._shard_name(key)
+        if shard is None:
+            return [s for s in cls._shards if s.startswith("{}.".format(key))]
+        return [shard] if shard in cls._shards else []
+
+    @classmethod
+    def _load_shard(cls, shard, revalidate):
+        shard_file = cls._shard_file(shard)
+        if shard_file in cls._file_stats and not revalidate:
+            return
+        stat = cls._file_stat(cls._pillar_path(shard_file))
+        if shard_file in cls._file_stats and cls._file_stats[shard_file] == stat:
+            return
+        shard_key = shard.replace(".", ":")
+        value = cls._get_dict_value(cls._load_file(shard_file), shard_key)
+        root, subtree = shard_key.split(":")
+        if value is not None:
+            cls._set_dict_value(cls.pillar_data, shard_key, value)
+        elif subtree in cls.pillar_data.get(root, {}):
+            del cls.pillar_data[root][subtree]
+        cls._file_stats[shard_file] = stat
+
+    @classmethod
+    def _load(cls, key=None):
+        if not cls._file_stats and not cls._journal_keys and \
+                os.path.exists(cls._pillar_path(cls.JOURNAL_FILE)):
+            cls._recover_journal()
+        cls._load_files(key)
+
+    @classmethod
+    def _load_files(cls, key):
+        # while the cache holds changes not yet written to the pillar files, the
+        # already loaded data cannot be reloaded
+        revalidate = not cls._pending_keys and not cls._journal_keys
+        if revalidate:
+            stat = cls._file_stat(cls._pillar_path(cls.PILLAR_FILE))
+            if cls._file_stats.get(cls.PILLAR_FILE, False) != stat:
+                data = cls._load_file(cls.PILLAR_FILE)
+                cls._file_stats = {cls.PILLAR_FILE: stat}
+                if set(data) == {'include'}:
+                    cls._shards = list(data['include'])
+                    cls.pillar_data = {}
+                else:
+                    cls._shards = None
+                    cls.pillar_data = data
+                    cls.logger.debug("Loaded pillar data: %s", cls.pillar_data)
+
+        if cls._shards is not None:
+            # shards are read lazily, unless the whole pillar will be rewritten as a
+            # single file
+            for shard in cls._key_shards(key if cls._is_sharded() else None):
+                cls._load_shard(shard, revalidate)
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drops the cached pillar data, forcing the next access to read the pillar files
+        (and replay the journal, if any)
+        """
+        cls._journal_keys = frozenset()
+        cls._journal_started = None
+        cls._file_stats = {}
+        cls._file_serializers = {}
+        cls._shards = None
+        cls._pillar_base_path = None
+
+    @classmethod
+    def _key_sls(cls, key):
+        """
+        Returns the names of the SLS files that include the pillar key
+        """
+        sls_names = {os.path.splitext(cls.PILLAR_FILE)[0]}
+        if cls._is_sharded() and cls._shard_name(key):
+            sls_names.add(cls._shard_name(key))
+        return sls_names
+
+    @classmethod
+    def _top_target(cls, sls_names):
+        """
+        Builds a compound target matching the minions whose pillar top file
+        entries include any of the SLS files.
+        Returns None if the top file cannot be used to compute such a target.
+        """
+        try:
+            top = cls._load_file(cls.TOP_FILE)
+        except (yaml.YAMLError, ValueError) as ex:
+            cls.logger.warning("Cannot parse pillar top file: %s", ex)
+            return None
+        if not isinstance(top, dict) or not isinstance(top.get('base'), dict):
+            return None
+
+        targets = []
+        for target, entries in top['base'].items():
+            if not isinstance(entries, list):
+                return None
+            match = 'glob'
+            sls_list = []
+            for entry in entries:
+                if isinstance(entry, dict):
+                    match = entry.get('match', match)
+                else:
+                    sls_list.append(entry)
+            if not set(sls_list) & sls_names:
+                continue
+            if match == 'compound':
+                targets.append('( {} )'.format(target))
+            elif match in cls._COMPOUND_PREFIXES:
+                targets.append('{}{}'.format(cls._COMPOUND_PREFIXES[match], target))
+            else:
+                cls.logger.info("Cannot convert top target '%s' of type '%s'", target, match)
+                return None
+        return " or ".join(targets)
+
+    @classmethod
+    @timed('pillar.refresh')
+    def _refresh(cls, keys):
+        target = cls.refresh_target
+        if cls.refresh_affected_only:
+            top_target = cls._top_target(set().union(*[cls._key_sls(key) for key in keys]))
+            if top_target == "":
+                cls.logger.info("No minion depends on pillar keys %s, skipping refresh", keys)
+                return
+            if top_target is not None:
+                target = "( {} ) and ( {} )".format(target, top_target)
+        cls.logger.info("Refreshing pillar of minions matching: %s", target)
+        SaltJobs.run(target, 'saltutil.pillar_refresh', tgt_type="compound",
+                     operation=SaltJobs.PILLAR_REFRESH)
+
+    @classmethod
+    def _save_file_stat(cls, data, custom_file):
+        cls._save_file(data, custom_file)
+        cls._file_stats[custom_file] = cls._file_stat(cls._pillar_path(custom_file))
+
+    @classmethod
+    def _remove_file(cls, custom_file):
+        full_path = cls._pillar_path(custom_file)
+        if os.path.exists(full_path):
+            cls.logger.info("Removing pillar file: %s", full_path)
+            os.remove(full_path)
+        cls._file_stats.pop(custom_file, None)
+
+    @classmethod
+    def _save_shards(cls, keys):
+        if cls._shards is None:
+            # migrating from a single pillar file
+            shards = set()
+            dirty = {"{}.{}".format(root, subtree) for root, value in cls.pillar_data.items()
+                     for subtree in value}
+        else:
+            shards = set(cls._shards)
+            dirty = set()
+            for key in keys:
+                if cls._shard_name(key):
+                    dirty.add(cls._shard_name(key))
+                else:
+                    dirty.update(cls._key_shards(key))
+                    dirty.update("{}.{}".format(key, subtree)
+                                 for subtree in cls.pillar_data.get(key, {}))
+
+        for shard in sorted(dirty):
+            shard_key = shard.replace(".", ":")
+            value = cls._get_dict_value(cls.pillar_data, shard_key)
+            if value is None:
+                cls._remove_file(cls._shard_file(shard))
+                shards.discard(shard)
+            else:
+                root, subtree = shard_key.split(":")
+                cls._save_file_stat({root: {subtree: value}}, cls._shard_file(shard))
+                shards.add(shard)
+
+        shards = sorted(shards)
+        if shards != cls._shards:
+            cls._save_file_stat({'include': shards}, cls.PILLAR_FILE)
+            cls._shards = shards
+
+    @classmethod
+    def _write(cls, keys):
+        if cls._is_sharded():
+            cls._save_shards(keys)
+        else:
+            cls._save_file_stat(cls.pillar_data, cls.PILLAR_FILE)
+            if cls._shards is not None:
+                for shard in cls._shards:
+                    cls._remove_file(cls._shard_file(shard))
+                cls._shards = None
+
+    @classmethod
+    @timed('pillar.append_journal')
+    def _append_journal(cls, keys):
+        records = []
+        # parents first, so that replaying the records yields the same data
+        for key in sorted(keys, key=lambda k: k.count(":")):
+            value = cls._get_dict_value(cls.pillar_data, key)
+            if value is None:
+                records.append(json.dumps({'op': 'reset', 'key': key}))
             else:
-                file.write(content)
-            file.write("\n")
+                records.append(json.dumps({'op': 'set', 'key': key, 'value': value}))
+        full_path = cls._pillar_path(cls.JOURNAL_FILE)
+        created = not os.path.exists(full_path)
+        fd = os.open(full_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'a') as file:
+            file.write("\n".join(records) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if created:
+            fsync_dir(os.path.dirname(full_path))
 
     @classmethod
-    def _load(cls):
-        if not cls.pillar_data:
-            cls.pillar_data = cls._load_yaml(cls.PILLAR_FILE)
-            cls.logger.debug("Loaded pillar data: %s", cls.pillar_data)
+    def _remove_journal(cls):
+        full_path = cls._pillar_path(cls.JOURNAL_FILE)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+            fsync_dir(os.path.dirname(full_path))
 
     @classmethod
+    def _recover_journal(cls):
+        full_path = cls._pillar_path(cls.JOURNAL_FILE)
+        cls.logger.warning("Replaying pillar journal: %s", full_path)
+        cls._load_files(None)
+        keys = set()
+        with open(full_path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record may be incomplete if sesboot was interrupted
+                    cls.logger.warning("Skipping invalid journal record: %s", line)
+                    continue
+                if record['op'] == 'set':
+                    cls._set_dict_value(cls.pillar_data, record['key'], record['value'])
+                elif cls._get_dict_value(cls.pillar_data, record['key']) is not None:
+                    cls._del_dict_key(cls.pillar_data, record['key'])
+                keys.add(record['key'])
+        if keys:
+            cls._write(keys)
+        cls._remove_journal()
+        if keys:
+            cls._refresh(keys)
+
+    @classmethod
+    def _compact_when_due(cls):
+        # the compaction refreshes the minions, so it runs in the committing thread
+        # rather than in the background, where it would share the Salt clients with
+        # the jobs of that thread. Changes not due yet wait for a later commit or exit.
+        if not cls._atexit_registered:
+            atexit.register(cls.compact)
+            cls._atexit_registered = True
+        delay = cls.journal_compaction_delay
+        if delay is not None and time.monotonic() - cls._journal_started >= delay:
+            cls.compact()
+
+    @classmethod
+    @timed('pillar.compact')
+    def compact(cls):
+        """
+        Writes the journaled changes to the pillar files, clears the journal and
+        refreshes the minions
+        """
+        with cls._lock:
+            if cls._transaction_depth > 0 or not cls._journal_keys:
+                # an ongoing transaction compacts the journal when committed, if due
+                return
+            keys, cls._journal_keys = cls._journal_keys, frozenset()
+            cls._journal_started = None
+            cls.logger.info("Compacting pillar journal")
+            cls._write(keys)
+            cls._remove_journal()
+            cls._refresh(keys)
+
+    @classmethod
+    @timed('pillar.commit')
+    def _commit(cls, key=None):
+        if key is not None:
+            cls._pending_keys = cls._pending_keys | {key}
+        if cls._transaction_depth > 0:
+            return
+        keys, cls._pending_keys = cls._pending_keys, frozenset()
+        if cls.journal:
+            cls._append_journal(keys)
+            cls._journal_keys = cls._journal_keys | keys
+            if cls._journal_started is None:
+                cls._journal_started = time.monotonic()
+            cls._compact_when_due()
+        else:
+            cls._write(keys)
+            cls._refresh(keys)
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Groups all `set` and `reset` calls done inside the context, so that the
+        pillar file is written, and the minions refreshed, only once when the
+        outermost transaction ends.
+        Changes are committed even if the context exits with an exception,
+        because they usually mirror grains that were already changed.
+        """
+        with cls._lock:
+            cls._transaction_depth += 1
+        try:
+            yield
+        finally:
+            with cls._lock:
+                cls._transaction_depth -= 1
+                if cls._transaction_depth == 0 and cls._pending_keys:
+                    cls.logger.info("Committing pillar transaction")
+                    cls._commit()
+
+    @classmethod
+    @timed('pillar.get')
     def get(cls, key):
-        cls._load()
-        res = cls._get_dict_value(cls.pillar_data, key)
+        with cls._lock:
+            cls._load(key)
+            res = cls._get_dict_value(cls.pillar_data, key)
         if key == 'ses:ssh:private_key':
             # don't log key value
             cls.logger.info("Got '%s' from pillar", key)
@@ -193,23 +940,25 @@ class PillarManager:
         return res
 
     @classmethod
+    @timed('pillar.set')
     def set(cls, key, value):
-        cls._load()
-        cls._set_dict_value(cls.pillar_data, key, value)
-        cls._save_yaml(cls.pillar_data, cls.PILLAR_FILE)
-        SaltClient.local().cmd('*', 'saltutil.pillar_refresh', tgt_type="compound")
+        with cls._lock:
+            cls._load(key)
+            cls._set_dict_value(cls.pillar_data, key, value)
+            cls._commit(key)
         if key == 'ses:ssh:private_key':
             cls.logger.info("Set '%s' to pillar", key)
         else:
             cls.logger.info("Set '%s' to pillar: '%s'", key, value)
 
     @classmethod
+    @timed('pillar.reset')
     def reset(cls, key):
-        cls._load()
-        logger.debug("Deleting key '%s' from pillar", key)
-        if cls._get_dict_value(cls.pillar_data, key) is None:
-            return
-        cls._del_dict_key(cls.pillar_data, key)
-        cls._save_yaml(cls.pillar_data, cls.PILLAR_FILE)
-        SaltClient.local().cmd('*', 'saltutil.pillar_refresh', tgt_type="compound")
+        with cls._lock:
+            cls._load(key)
+            logger.debug("Deleting key '%s' from pillar", key)
+            if cls._get_dict_value(cls.pillar_data, key) is None:
+                return
+            cls._del_dict_key(cls.pillar_data, key)
+            cls._commit(key)
         cls.logger.info("Deleted '%s' from pillar", key)
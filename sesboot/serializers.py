@@ -0,0 +1,66 @@
+import json
+import logging
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+logger = logging.getLogger(__name__)
+
+
+class YamlSerializer:
+    """
+    Default pillar format, uses the libyaml bindings when available
+    """
+    name = 'yaml'
+
+    @staticmethod
+    def load(content):
+        return yaml.load(content, Loader=SafeLoader)
+
+    @staticmethod
+    def dump(data):
+        content = yaml.dump(data, Dumper=SafeDumper, default_flow_style=False)
+        if content == '{}\n':
+            content = ""
+        return content + "\n"
+
+
+class JsonSerializer:
+    """
+    Stores the pillar as JSON, which the Salt master renders much faster than YAML
+    """
+    name = 'json'
+    SHEBANG = '#!json'
+
+    @classmethod
+    def load(cls, content):
+        if content.startswith(cls.SHEBANG):
+            content = content[len(cls.SHEBANG):]
+        if not content.strip():
+            return None
+        return json.loads(content)
+
+    @classmethod
+    def dump(cls, data):
+        return "{}\n{}\n".format(cls.SHEBANG, json.dumps(data, indent=2, sort_keys=True))
+
+
+SERIALIZERS = {serializer.name: serializer for serializer in [YamlSerializer, JsonSerializer]}
+
+
+def serializer_for(content):
+    """
+    Returns the serializer able to parse the content of an SLS file
+    """
+    if content.startswith(JsonSerializer.SHEBANG):
+        return JsonSerializer
+    return YamlSerializer
+
+
+def using_libyaml():
+    return SafeLoader is not yaml.SafeLoader
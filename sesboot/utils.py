@@ -0,0 +1,49 @@
+import os
+import tempfile
+
+
+def atomic_write(full_path, content, mode=0o644):
+    """
+    Writes the content to a temporary file in the same directory, and renames it
+    over full_path once it is safely stored, so that readers always see either
+    the old or the new content.
+    The permissions and ownership of an existing file are preserved.
+    """
+    dir_path = os.path.dirname(full_path)
+    os.makedirs(dir_path, exist_ok=True)
+    try:
+        stat = os.stat(full_path)
+    except FileNotFoundError:
+        stat = None
+
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.{}.'.format(os.path.basename(full_path)),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        if stat is not None:
+            os.chmod(tmp_path, stat.st_mode & 0o7777)
+            try:
+                os.chown(tmp_path, stat.st_uid, stat.st_gid)
+            except PermissionError:
+                pass
+        else:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    fsync_dir(dir_path)
+
+
+def fsync_dir(dir_path):
+    """
+    Makes a file creation, rename or removal in the directory durable
+    """
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
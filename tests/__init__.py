@@ -2,13 +2,20 @@ import os
 import fnmatch
 import logging
 import logging.config
+import time
 import unittest
 from collections import defaultdict
 
+# sesboot imports Salt modules lazily, and they cannot be imported for the
+# first time while the fake filesystem is active
+import salt.utils.data  # pylint: disable=unused-import
 import yaml
 from mock import patch
 from pyfakefs.fake_filesystem_unittest import TestCase
 
+from sesboot.model import SesNodeManager
+from sesboot.salt_utils import MinionDataCache, MinionKeysManager, PillarManager
+
 
 logging.config.dictConfig({
     'version': 1,
@@ -39,17 +46,29 @@ class SaltGrainsMock:
     def __init__(self):
         self.logger = logging.getLogger(SaltGrainsMock.__name__)
         self.grains = {}
+        # grains seen by the master minion data cache, if they are not up to date
+        self.cached = None
 
     def setval(self, key, value):
         self.logger.info('setval %s, %s', key, value)
         self.grains[key] = value
+        # grains.setval refreshes the pillar, which updates the master cache
+        self.cached = None
+        return {key: value}
 
     def get(self, key):
         self.logger.info('get %s', key)
         return self.grains[key]
 
+    def item(self, *keys):
+        self.logger.info('item %s', keys)
+        return {key: self.grains.get(key, '') for key in keys}
+
     def delkey(self, key):
         self.logger.info('delkey %s', key)
+        # like Salt 2019.2, grains.delkey does not update the master cache
+        if self.cached is None:
+            self.cached = dict(self.grains)
         del self.grains[key]
 
     def enumerate_entries(self, _dict=None):
@@ -87,15 +106,36 @@ class SaltLocalClientMock:
     def __init__(self):
         self.logger = logging.getLogger(SaltLocalClientMock.__name__)
         self.grains = defaultdict(SaltGrainsMock)
+        self.mine = {}
+        self.jobs = []
+        self.batches = []
 
     def _parse_module(self, module):
         return module.split('.', 1)
 
+    def cmd_iter(self, target, module, args=None, tgt_type=None, yield_pub_data=False,
+                 **kwargs):
+        self.logger.info('cmd_iter %s, %s, %s, tgt_type=%s, kwargs=%s', target, module, args,
+                         tgt_type, kwargs)
+        result = self.cmd(target, module, args, tgt_type)
+        if yield_pub_data:
+            yield {'jid': str(len(self.jobs)), 'minions': list(result)}
+        for minion, ret in result.items():
+            yield {minion: {'ret': ret, 'retcode': 0}}
+
+    def cmd_batch(self, target, module, args=None, tgt_type=None, batch=None, **kwargs):
+        self.logger.info('cmd_batch %s, %s, %s, tgt_type=%s, batch=%s, kwargs=%s', target,
+                         module, args, tgt_type, batch, kwargs)
+        self.batches.append(batch)
+        for minion, ret in self.cmd(target, module, args, tgt_type).items():
+            yield {minion: ret}
+
     def cmd(self, target, module, args=None, tgt_type=None):
         self.logger.info('cmd %s, %s, %s, tgt_type=%s', target, module, args, tgt_type)
 
         if args is None:
             args = []
+        self.jobs.append((target, module, tgt_type))
 
         targets = []
         if tgt_type == 'grain':
@@ -103,6 +143,8 @@ class SaltLocalClientMock:
                 self.logger.info("grain filtering: %s <-> %s", grains.enumerate_entries(), target)
                 if fnmatch.filter(grains.enumerate_entries(), target):
                     targets.append(minion)
+        elif tgt_type == 'list':
+            targets.extend(target)
         else:
             targets.append(target)
 
@@ -115,12 +157,36 @@ class SaltLocalClientMock:
                 result[tgt] = getattr(TestMock, func)(*args)
             elif mod == 'saltutil':
                 result[tgt] = getattr(SaltUtilMock, func)(*args)
+                if func == 'pillar_refresh' and tgt in self.grains:
+                    self.grains[tgt].cached = None
             else:
                 raise NotImplementedError()
 
         return result
 
 
+class SaltCacheMock:
+    """
+    Master minion data cache holding the grains and mine data of the local
+    client mock
+    """
+    def __init__(self, local_client):
+        self.local_client = local_client
+        self.updated_at = int(time.time())
+
+    def fetch(self, bank, key):
+        minion = bank.split('/', 1)[1]
+        if key == 'mine':
+            return dict(self.local_client.mine.get(minion, {}))
+        if key != 'data' or minion not in self.local_client.grains:
+            return {}
+        grains = self.local_client.grains[minion]
+        return {'grains': dict(grains.cached if grains.cached is not None else grains.grains)}
+
+    def updated(self, bank, key):
+        return self.updated_at if self.fetch(bank, key) else None
+
+
 class SaltClientMock:
     local_client = SaltLocalClientMock()
     local_fs = None
@@ -129,10 +195,18 @@ class SaltClientMock:
     def local(cls):
         return cls.local_client
 
+    @classmethod
+    def cache(cls):
+        return SaltCacheMock(cls.local_client)
+
     @classmethod
     def pillar_fs_path(cls):
         return '/srv/pillar'
 
+    @classmethod
+    def pki_dir(cls):
+        return '/etc/salt/pki/master'
+
 
 # pylint: disable=invalid-name
 class SaltMockTestCase(TestCase):
@@ -148,6 +222,11 @@ class SaltMockTestCase(TestCase):
         SaltClientMock.local_fs = self.fs
         self.fs.create_dir(SaltClientMock.pillar_fs_path())
         self.fs.create_file(os.path.join(SaltClientMock.pillar_fs_path(), 'ses.sls'))
+        self.fs.create_dir(os.path.join(SaltClientMock.pki_dir(), 'minions'))
+        PillarManager.invalidate()
+        MinionKeysManager.invalidate()
+        MinionDataCache.invalidate()
+        SesNodeManager.invalidate()
         self.addCleanup(patcher.stop)
 
     def assertGrains(self, target, key, value):
@@ -166,5 +245,5 @@ class SaltMockTestCase(TestCase):
     def assertYamlEqual(self, file_path, _dict):
         data = None
         with open(file_path, 'r') as file:
-            data = yaml.load(file)
+            data = yaml.safe_load(file)
         self.assertDictEqual(data, _dict)
@@ -0,0 +1,118 @@
+# pylint: disable=protected-access
+import io
+import os
+
+from mock import patch
+
+from sesboot.config_shell import SesBootConfigShell, generate_config_shell_tree, \
+    run_config_script
+from sesboot.model import SesNodeManager
+from sesboot.salt_utils import GrainsManager, PillarManager
+from . import SaltMockTestCase
+
+
+class ConfigShellTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(ConfigShellTest, self).setUp()
+        self.shell = SesBootConfigShell()
+        generate_config_shell_tree(self.shell)
+
+    def test_lazy_tree(self):
+        with patch.object(SesNodeManager, 'ses_nodes', return_value={}) as ses_nodes, \
+                patch.object(PillarManager, 'get', wraps=PillarManager.get) as pillar_get:
+            root = self.shell._root_node
+            storage = root.get_child('Storage')
+            self.assertEqual(storage._children, set())
+            self.shell.run_cmdline('/Storage ls')
+            self.assertEqual({child.name for child in storage.children}, {'Drive_Groups'})
+            ses_nodes.assert_not_called()
+            self.assertEqual({call[0][0] for call in pillar_get.call_args_list},
+                             {'ses:storage:drive_groups'})
+            self.assertEqual(root.get_child('Cluster')._children, set())
+
+
+class ConfigScriptTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(ConfigScriptTest, self).setUp()
+        local = self.local_client.local()
+        local.grains.clear()
+        local.mine.clear()
+        self.addCleanup(local.grains.clear)
+        for idx in range(1, 5):
+            minion = 'node{}.ses'.format(idx)
+            self.fs.create_file(os.path.join('/etc/salt/pki/master/minions', minion))
+            GrainsManager.set_grain(minion, 'fqdn_ip4', ['10.0.0.{}'.format(idx)])
+        del local.jobs[:]
+
+    def _run(self, script, stop_on_error=False):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            failed = run_config_script(io.StringIO(script), stop_on_error)
+        return failed, stdout.getvalue()
+
+    def test_script(self):
+        failed, output = self._run("# deployment\n"
+                                   "/Cluster/Minions add node*\n"
+                                   "\n"
+                                   "/Cluster/Roles/Mon add node1.ses\n"
+                                   "/Cluster/Roles/Mon add node2.ses\n"
+                                   "/Cluster/Roles/Mgr add node1.ses\n")
+        self.assertEqual(failed, 0)
+        self.assertEqual(output, "OK\n")
+        jobs = [job[1] for job in self.local_client.local().jobs]
+        # one grains job per distinct roles value, and a single pillar refresh
+        self.assertEqual(jobs, ['grains.setval'] * 3 + ['saltutil.pillar_refresh'])
+        self.assertGrains('node1.ses', 'ses', {'member': True, 'roles': ['mgr', 'mon']})
+        self.assertGrains('node3.ses', 'ses', {'member': True, 'roles': []})
+        self.assertEqual(PillarManager.get('ses:minions:mon'),
+                         {'node1': '10.0.0.1', 'node2': '10.0.0.2'})
+
+    def test_script_errors(self):
+        script = ("/Cluster/Minions add node1.ses\n"
+                  "/Cluster/Roles/Mon del node1.ses\n"
+                  "/Cluster/Roles/Mon add node1.ses\n")
+        failed, output = self._run(script)
+        self.assertEqual(failed, 1)
+        self.assertTrue(output.startswith("Line 2: /Cluster/Roles/Mon del node1.ses: "))
+        self.assertGrains('node1.ses', 'ses', {'member': True, 'roles': ['mon']})
+
+        SesNodeManager.invalidate()
+        failed, output = self._run(script.replace('Mon', 'Mgr'), stop_on_error=True)
+        self.assertEqual(failed, 1)
+        self.assertGrains('node1.ses', 'ses', {'member': True, 'roles': ['mon']})
+
+    def _shell_session(self):
+        # a new process, that loads the nodes from the inventory snapshot
+        SesNodeManager.invalidate()
+        shell = SesBootConfigShell()
+        generate_config_shell_tree(shell)
+        return shell, shell._root_node.get_child('Cluster').get_child('Minions')
+
+    def test_shell_snapshot_revalidated(self):
+        self._run("/Cluster/Minions add node1.ses\n"
+                  "/Cluster/Minions add node2.ses\n")
+        shell, minions = self._shell_session()
+        with patch('sys.stdout', new_callable=io.StringIO):
+            shell.run_cmdline('/Cluster/Minions ls')
+            self.assertIsNotNone(SesNodeManager.snapshot_age())
+            shell.run_cmdline('/Cluster/Roles/Mon add node1.ses')
+        self.assertIsNone(SesNodeManager.snapshot_age())
+        self.assertGrains('node1.ses', 'ses', {'member': True, 'roles': ['mon']})
+        self.assertEqual(minions.get_child('node1.ses').summary(), ('mon', None))
+
+    def test_shell_refresh(self):
+        self._run("/Cluster/Minions add node1.ses\n"
+                  "/Cluster/Minions add node2.ses\n")
+        shell, minions = self._shell_session()
+        with patch('sys.stdout', new_callable=io.StringIO):
+            shell.run_cmdline('/Cluster/Minions ls')
+            self.assertEqual(minions.summary()[0], 'Minions: 2')
+            # changed by another sesboot process
+            GrainsManager.set_grain('node1.ses', 'ses', {'member': True, 'roles': ['mgr']})
+            GrainsManager.set_grain('node3.ses', 'ses', {'member': True, 'roles': []})
+            shell.run_cmdline('/Cluster refresh')
+        self.assertEqual(minions.summary()[0], 'Minions: 3')
+        self.assertEqual({child.name for child in minions.children},
+                         {'node1.ses', 'node2.ses', 'node3.ses'})
+        self.assertEqual(minions.get_child('node1.ses').summary(), ('mgr', None))
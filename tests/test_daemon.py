@@ -0,0 +1,124 @@
+# pylint: disable=protected-access
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from sesboot.daemon import ConfigDaemon, send_commands
+from sesboot.exceptions import DaemonAlreadyRunningException, DaemonNotRunningException
+from sesboot.inventory import InventorySnapshot
+from sesboot.model import SesNodeManager
+from sesboot.salt_utils import GrainsManager, PillarManager
+from . import SaltMockTestCase
+
+
+class ConfigDaemonTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(ConfigDaemonTest, self).setUp()
+        local = self.local_client.local()
+        local.grains.clear()
+        self.addCleanup(local.grains.clear)
+        for idx in range(1, 3):
+            minion = 'node{}.ses'.format(idx)
+            self.fs.create_file(os.path.join('/etc/salt/pki/master/minions', minion))
+            GrainsManager.set_grain(minion, 'fqdn_ip4', ['10.0.0.{}'.format(idx)])
+        ConfigDaemon._shell = None
+        ConfigDaemon._snapshot_stat = None
+        self.addCleanup(setattr, ConfigDaemon, '_shell', None)
+
+    def test_execute(self):
+        response = ConfigDaemon.execute({'commands': ['/Cluster/Minions add node*',
+                                                      '/Cluster/Roles/Mon add node1.ses']})
+        self.assertEqual(response, {'output': "OK\n", 'failed': 0})
+        self.assertGrains('node1.ses', 'ses', {'member': True, 'roles': ['mon']})
+
+        # the nodes stay loaded while nobody else changes the inventory
+        with patch.object(SesNodeManager, 'invalidate') as invalidate:
+            response = ConfigDaemon.execute({'commands': ['/Cluster/Minions ls'],
+                                             'stop_on_error': True})
+            invalidate.assert_not_called()
+        self.assertIn('node2.ses', response['output'])
+
+        InventorySnapshot.save({}, [])
+        with patch.object(SesNodeManager, 'invalidate') as invalidate:
+            ConfigDaemon.execute({'commands': ['/Cluster ls']})
+            invalidate.assert_called_once_with()
+
+    def test_execute_no_inventory_cache(self):
+        ConfigDaemon.execute({'commands': ['/Cluster/Minions add node*']})
+        with patch.object(InventorySnapshot, 'enabled', False), \
+                patch.object(SesNodeManager, 'invalidate') as invalidate:
+            ConfigDaemon.execute({'commands': ['/Cluster/Minions ls']})
+            ConfigDaemon.execute({'commands': ['/Cluster ls']})
+            invalidate.assert_not_called()
+
+    def test_execute_journal(self):
+        PillarManager.journal = True
+        self.addCleanup(setattr, PillarManager, 'journal', False)
+        with patch.object(PillarManager, 'journal_compaction_delay', None):
+            ConfigDaemon.execute({'commands': ['/Cluster/Minions add node*',
+                                               '/Cluster/Roles/Mon add node1.ses']})
+        # the request compacted the journal, it is not left to a later request
+        self.assertIsNone(PillarManager._journal_started)
+        self.assertFalse(os.path.exists(PillarManager._pillar_path(PillarManager.JOURNAL_FILE)))
+        self.assertIn('saltutil.pillar_refresh',
+                      [job[1] for job in self.local_client.local().jobs])
+        PillarManager.invalidate()
+        self.assertEqual(PillarManager.get('ses:minions:mon'), {'node1': '10.0.0.1'})
+
+    def test_execute_errors(self):
+        response = ConfigDaemon.execute({'commands': ['/Cluster/Roles/Mon del node1.ses']})
+        self.assertEqual(response['failed'], 1)
+        self.assertTrue(response['output'].startswith("Line 1: "))
+
+
+class DaemonSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.socket_path = os.path.join(tmp_dir, 'run', 'sesboot.sock')
+        patcher = patch.object(ConfigDaemon, 'socket_path', self.socket_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start_server(self):
+        server = ConfigDaemon.create_server()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_request(self):
+        self._start_server()
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+        with patch.object(ConfigDaemon, 'execute',
+                          return_value={'output': "OK\n", 'failed': 0}) as execute:
+            response = send_commands(['/Cluster ls'], stop_on_error=True)
+        execute.assert_called_once_with({'commands': ['/Cluster ls'], 'stop_on_error': True})
+        self.assertEqual(response, {'output': "OK\n", 'failed': 0})
+
+        with patch.object(ConfigDaemon, 'execute', side_effect=Exception('boom')):
+            self.assertEqual(send_commands(['/Cluster ls']), {'error': 'boom'})
+
+    def test_already_running(self):
+        self._start_server()
+        with self.assertRaises(DaemonAlreadyRunningException):
+            ConfigDaemon.create_server()
+
+    def test_stale_socket(self):
+        os.makedirs(os.path.dirname(self.socket_path))
+        open(self.socket_path, 'w').close()
+        self._start_server()
+        with patch.object(ConfigDaemon, 'execute', return_value={'output': "", 'failed': 0}):
+            self.assertEqual(send_commands(['/Cluster ls'])['failed'], 0)
+
+    def test_not_running(self):
+        with self.assertRaises(DaemonNotRunningException):
+            send_commands(['/Cluster ls'])
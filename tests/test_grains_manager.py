@@ -1,4 +1,6 @@
-from sesboot.salt_utils import GrainsManager
+from mock import patch
+
+from sesboot.salt_utils import GrainsManager, SaltJobs
 from . import SaltMockTestCase
 
 
@@ -25,3 +27,59 @@ class GrainsManagerTest(SaltMockTestCase):
         GrainsManager.set_grain('node3', 'ses', {'member': True, 'roles': ['storage']})
         result = GrainsManager.filter_by('ses:member')
         self.assertEqual(set(result), {'node1', 'node2', 'node3'})
+
+    def test_grains_set_bulk(self):
+        local = self.local_client.local()
+        del local.jobs[:]
+        status = GrainsManager.set_grains('ses', {
+            'node1': {'member': True, 'roles': ['mgr', 'mon']},
+            'node2': {'roles': ['mgr', 'mon'], 'member': True},
+            'node3': {'member': True, 'roles': []},
+        })
+        self.assertEqual(status, {'node1': True, 'node2': True, 'node3': True})
+        self.assertEqual(len(local.jobs), 2)
+        self.assertTrue(all(job[2] == 'list' for job in local.jobs))
+        self.assertGrains('node2', 'ses', {'member': True, 'roles': ['mgr', 'mon']})
+        self.assertGrains('node3', 'ses', {'member': True, 'roles': []})
+
+    def test_grains_set_bulk_failure(self):
+        local = self.local_client.local()
+        returns = [{'jid': '1', 'minions': ['node1', 'node2', 'node3']},
+                   {'node1': {'ret': {'ses': 1}}}, {'node2': {'ret': 'ERROR'}}]
+        with patch.object(local, 'cmd_iter', return_value=iter(returns)):
+            status = GrainsManager.set_grains('ses', {'node1': 1, 'node2': 1, 'node3': 1})
+        self.assertEqual(status, {'node1': True, 'node2': False, 'node3': False})
+
+    def test_grains_stream(self):
+        GrainsManager.set_grain(['node1', 'node2'], 'ses', {'member': True})
+        progress = []
+        SaltJobs.progress = progress.append
+        try:
+            stream = GrainsManager.iter_grains(['node1', 'node2'], ['ses'])
+            minion, grains = next(stream)
+            self.assertEqual(minion, 'node1')
+            self.assertEqual(grains, {'ses': {'member': True}})
+            # the first minion is available before the second one answers
+            self.assertEqual([(p.done, p.total, p.finished) for p in progress],
+                             [(0, 2, False), (1, 2, False)])
+            self.assertEqual(dict(stream), {'node2': {'ses': {'member': True}}})
+        finally:
+            SaltJobs.progress = None
+        self.assertEqual((progress[-1].done, progress[-1].total, progress[-1].finished),
+                         (2, 2, True))
+        self.assertEqual(progress[-1].fun, 'grains.item')
+
+    def test_grains_set_batch(self):
+        local = self.local_client.local()
+        SaltJobs.batch_sizes = {SaltJobs.GRAINS_WRITE: '25%'}
+        try:
+            status = GrainsManager.set_grains('ses', {'node1': 1, 'node2': 1, 'node3': 2})
+            GrainsManager.del_grain(['node1', 'node2'], 'ses')
+            # reads are not batched
+            GrainsManager.get_grains(['node3'], ['ses'])
+        finally:
+            SaltJobs.batch_sizes = {}
+        self.assertEqual(status, {'node1': True, 'node2': True, 'node3': True})
+        self.assertEqual(local.batches, ['25%', '25%', '25%'])
+        self.assertNotInGrains('node1', 'ses')
+        self.assertGrains('node3', 'ses', 2)
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import unittest
+
+
+class ImportTimeTest(unittest.TestCase):
+    # modules that must only be imported by the commands that need them
+    HEAVY_MODULES = ['salt', 'Cryptodome', 'configshell_fb', 'pyparsing', 'pkg_resources']
+    # generous upper bound for the cumulative import time of sesboot, in microseconds
+    IMPORT_TIME_BUDGET = 500000
+
+    @staticmethod
+    def _import_times(module):
+        """
+        Runs `python -X importtime -c "import <module>"` and returns a dict of the
+        form {module: cumulative import time (us)}
+        """
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               'import {}'.format(module)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, check=True)
+        times = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+        return times
+
+    def test_no_heavy_imports(self):
+        times = self._import_times('sesboot')
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, times,
+                             "'import sesboot' should not import '{}'".format(module))
+
+    def test_import_time_budget(self):
+        times = self._import_times('sesboot')
+        self.assertLess(times['sesboot'], self.IMPORT_TIME_BUDGET)
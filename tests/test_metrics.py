@@ -0,0 +1,77 @@
+import io
+import unittest
+
+from sesboot.metrics import Metrics, Profiler, timed
+from sesboot.salt_utils import GrainsManager, PillarManager
+from . import SaltMockTestCase
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        Metrics.reset()
+        Metrics.enabled = True
+        self.addCleanup(setattr, Metrics, 'enabled', False)
+        self.addCleanup(Metrics.reset)
+
+    def test_record(self):
+        Metrics.record('salt.job:test.ping', 0.5, targets=3, returned=2)
+        Metrics.record('salt.job:test.ping', 1.5, targets=3, returned=3)
+        stat = Metrics.stats()['salt.job:test.ping']
+        self.assertEqual(stat['count'], 2)
+        self.assertAlmostEqual(stat['time'], 2.0)
+        self.assertAlmostEqual(stat['max'], 1.5)
+        self.assertEqual((stat['targets'], stat['returned']), (6, 5))
+
+    def test_disabled(self):
+        Metrics.enabled = False
+        Metrics.record('salt.job:test.ping', 0.5)
+        self.assertEqual(Metrics.stats(), {})
+
+    def test_timed(self):
+        @timed('op')
+        def operation(value):
+            return value * 2
+
+        self.assertEqual(operation(2), 4)
+        self.assertEqual(Metrics.stats()['op']['count'], 1)
+        self.assertIsNone(Metrics.stats()['op']['targets'])
+
+    def test_summary(self):
+        Metrics.record('fast', 0.1)
+        Metrics.record('slow', 2.0, targets=10, returned=9)
+        lines = Metrics.summary().split("\n")
+        self.assertTrue(lines[0].startswith('operation'))
+        self.assertTrue(lines[1].startswith('slow'))
+        self.assertTrue(lines[2].startswith('fast'))
+        self.assertTrue(lines[2].endswith('-'))
+
+    def test_profile(self):
+        out = io.StringIO()
+        Profiler.start()
+        sum(range(1000))
+        Profiler.report(out)
+        self.assertIn('CPU profile', out.getvalue())
+        self.assertIn('Memory: current=', out.getvalue())
+
+
+class SaltMetricsTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(SaltMetricsTest, self).setUp()
+        Metrics.reset()
+        Metrics.enabled = True
+        self.addCleanup(setattr, Metrics, 'enabled', False)
+        self.addCleanup(Metrics.reset)
+
+    def test_instrumented_calls(self):
+        GrainsManager.set_grains('ses', {'node1': 1, 'node2': 1})
+        PillarManager.set('ses:test', 'value')
+        stats = Metrics.stats()
+        self.assertEqual(stats['grains.set_grains']['count'], 1)
+        self.assertEqual(stats['salt.job:grains.setval']['targets'], 2)
+        self.assertEqual(stats['salt.job:grains.setval']['returned'], 2)
+        self.assertEqual(stats['salt.job:saltutil.pillar_refresh']['count'], 1)
+        for name in ['pillar.set', 'pillar.commit', 'pillar.refresh', 'pillar.file:read',
+                     'pillar.file:parse', 'pillar.file:serialize', 'pillar.file:write']:
+            self.assertIn(name, stats)
@@ -0,0 +1,40 @@
+import os
+import time
+
+from mock import patch
+
+from sesboot.salt_utils import MinionKeysManager
+from . import SaltMockTestCase, SaltClientMock as SaltClient
+
+
+class MinionKeysManagerTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(MinionKeysManagerTest, self).setUp()
+        self.keys_dir = os.path.join(SaltClient.pki_dir(), 'minions')
+        for minion in ['node1', 'node2']:
+            self.fs.create_file(os.path.join(self.keys_dir, minion))
+
+    def test_accepted_minions(self):
+        self.assertEqual(MinionKeysManager.accepted_minions(), {'node1', 'node2'})
+
+    def test_accepted_minions_cached(self):
+        MinionKeysManager.accepted_minions()
+        with patch('os.listdir') as listdir:
+            self.assertEqual(MinionKeysManager.accepted_minions(), {'node1', 'node2'})
+            listdir.assert_not_called()
+
+    def test_accepted_minions_refreshed(self):
+        MinionKeysManager.accepted_minions()
+        self.fs.create_file(os.path.join(self.keys_dir, 'node3'))
+        os.utime(self.keys_dir, ns=(0, os.stat(self.keys_dir).st_mtime_ns + 1))
+        self.assertEqual(MinionKeysManager.accepted_minions(), {'node1', 'node2', 'node3'})
+
+    def test_accepted_minions_ttl(self):
+        MinionKeysManager.accepted_minions()
+        mtime = os.stat(self.keys_dir).st_mtime_ns
+        os.remove(os.path.join(self.keys_dir, 'node2'))
+        os.utime(self.keys_dir, ns=(0, mtime))
+        self.assertEqual(MinionKeysManager.accepted_minions(), {'node1', 'node2'})
+        with patch('time.monotonic', return_value=time.monotonic() + MinionKeysManager.ttl + 1):
+            self.assertEqual(MinionKeysManager.accepted_minions(), {'node1'})
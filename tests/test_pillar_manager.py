@@ -1,11 +1,248 @@
+# pylint: disable=protected-access
 import os
+import threading
+
+from mock import patch
+
 from sesboot.salt_utils import PillarManager
+from sesboot.serializers import JsonSerializer, YamlSerializer
 from . import SaltMockTestCase, SaltClientMock as SaltClient
 
 
 class PillarManagerTest(SaltMockTestCase):
 
+    def _refresh_jobs(self):
+        return [job for job in self.local_client.local().jobs
+                if job[1] == 'saltutil.pillar_refresh']
+
     def test_pillar_set(self):
         PillarManager.set('ses:test:enabled', True)
         file_path = os.path.join(SaltClient.pillar_fs_path(), PillarManager.PILLAR_FILE)
         self.assertYamlEqual(file_path, {'ses': {'test': {'enabled': True}}})
+
+    def test_pillar_transaction(self):
+        del self.local_client.local().jobs[:]
+        file_path = os.path.join(SaltClient.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with PillarManager.transaction():
+            PillarManager.set('ses:test:enabled', True)
+            with PillarManager.transaction():
+                PillarManager.set('ses:test:name', 'foo')
+                PillarManager.set('ses:test:other', 'bar')
+            PillarManager.reset('ses:test:other')
+            self.assertEqual(os.path.getsize(file_path), 0)
+            self.assertEqual(PillarManager.get('ses:test:name'), 'foo')
+        self.assertYamlEqual(file_path, {'ses': {'test': {'enabled': True, 'name': 'foo'}}})
+        self.assertEqual(len(self._refresh_jobs()), 1)
+
+    def test_pillar_refresh_target(self):
+        del self.local_client.local().jobs[:]
+        PillarManager.set('ses:test:enabled', True)
+        self.assertEqual(self._refresh_jobs(),
+                         [('G@ses:member:True', 'saltutil.pillar_refresh', 'compound')])
+
+    def test_pillar_refresh_affected_only(self):
+        self.fs.create_file(os.path.join(SaltClient.pillar_fs_path(), PillarManager.TOP_FILE),
+                            contents="base:\n"
+                                     "  '*':\n"
+                                     "    - common\n"
+                                     "  'ceph*':\n"
+                                     "    - ses\n"
+                                     "  'G@os:SUSE and web*':\n"
+                                     "    - match: compound\n"
+                                     "    - ses\n")
+        del self.local_client.local().jobs[:]
+        PillarManager.refresh_affected_only = True
+        try:
+            PillarManager.set('ses:test:enabled', True)
+        finally:
+            PillarManager.refresh_affected_only = False
+        self.assertEqual(self._refresh_jobs(),
+                         [('( G@ses:member:True ) and ( ceph* or ( G@os:SUSE and web* ) )',
+                           'saltutil.pillar_refresh', 'compound')])
+
+    def test_pillar_cache_empty_file(self):
+        with patch.object(PillarManager, '_load_file', wraps=PillarManager._load_file) as load:
+            self.assertIsNone(PillarManager.get('ses:test:enabled'))
+            self.assertIsNone(PillarManager.get('ses:test:enabled'))
+            self.assertEqual(load.call_count, 1)
+
+    def test_pillar_cache_external_edit(self):
+        PillarManager.set('ses:test:enabled', True)
+        file_path = os.path.join(SaltClient.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with patch.object(PillarManager, '_load_file', wraps=PillarManager._load_file) as load:
+            self.assertTrue(PillarManager.get('ses:test:enabled'))
+            self.assertEqual(load.call_count, 0)
+            with open(file_path, 'w') as file:
+                file.write("ses:\n  test:\n    enabled: false\n    name: foo\n")
+            self.assertFalse(PillarManager.get('ses:test:enabled'))
+            self.assertEqual(PillarManager.get('ses:test:name'), 'foo')
+            self.assertEqual(load.call_count, 1)
+
+    def test_pillar_json_format(self):
+        PillarManager.set('ses:test:enabled', True)
+        PillarManager.serializer = JsonSerializer
+        try:
+            PillarManager.set('ses:test:name', 'foo')
+        finally:
+            PillarManager.serializer = None
+        file_path = os.path.join(SaltClient.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with open(file_path, 'r') as file:
+            self.assertEqual(file.readline(), '#!json\n')
+        PillarManager.invalidate()
+        self.assertEqual(PillarManager.get('ses:test'), {'enabled': True, 'name': 'foo'})
+
+        # runs without the option keep the format found on disk
+        PillarManager.set('ses:test:enabled', False)
+        with open(file_path, 'r') as file:
+            self.assertEqual(file.readline(), '#!json\n')
+
+        PillarManager.serializer = YamlSerializer
+        try:
+            PillarManager.set('ses:test:enabled', True)
+        finally:
+            PillarManager.serializer = None
+        self.assertYamlEqual(file_path, {'ses': {'test': {'enabled': True, 'name': 'foo'}}})
+
+
+class ShardedPillarManagerTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(ShardedPillarManagerTest, self).setUp()
+        PillarManager.sharded = True
+        self.addCleanup(setattr, PillarManager, 'sharded', None)
+
+    def _path(self, file_name):
+        return os.path.join(SaltClient.pillar_fs_path(), file_name)
+
+    def test_migrate_to_shards(self):
+        with open(self._path('ses.sls'), 'w') as file:
+            file.write("ses:\n  minions:\n    all: [node1]\n  ssh:\n    public_key: key\n")
+        PillarManager.set('ses:time_server:enabled', True)
+        self.assertYamlEqual(self._path('ses.sls'),
+                             {'include': ['ses.minions', 'ses.ssh', 'ses.time_server']})
+        self.assertYamlEqual(self._path('ses/minions.sls'),
+                             {'ses': {'minions': {'all': ['node1']}}})
+        self.assertYamlEqual(self._path('ses/ssh.sls'), {'ses': {'ssh': {'public_key': 'key'}}})
+        self.assertYamlEqual(self._path('ses/time_server.sls'),
+                             {'ses': {'time_server': {'enabled': True}}})
+
+    def test_write_only_changed_shard(self):
+        with PillarManager.transaction():
+            PillarManager.set('ses:minions:all', ['node1'])
+            PillarManager.set('ses:ssh:public_key', 'key')
+        ssh_stat = os.stat(self._path('ses/ssh.sls'))
+        index_stat = os.stat(self._path('ses.sls'))
+        with patch.object(PillarManager, '_save_file', wraps=PillarManager._save_file) as save:
+            PillarManager.set('ses:minions:all', ['node1', 'node2'])
+            save.assert_called_once_with({'ses': {'minions': {'all': ['node1', 'node2']}}},
+                                         'ses/minions.sls')
+        self.assertEqual(os.stat(self._path('ses/ssh.sls')), ssh_stat)
+        self.assertEqual(os.stat(self._path('ses.sls')), index_stat)
+
+    def test_lazy_shard_load(self):
+        with PillarManager.transaction():
+            PillarManager.set('ses:minions:all', ['node1'])
+            PillarManager.set('ses:ssh:public_key', 'key')
+        PillarManager.invalidate()
+        with patch.object(PillarManager, '_load_file', wraps=PillarManager._load_file) as load:
+            self.assertEqual(PillarManager.get('ses:ssh:public_key'), 'key')
+            self.assertEqual([c[0][0] for c in load.call_args_list], ['ses.sls', 'ses/ssh.sls'])
+            self.assertEqual(PillarManager.get('ses:ssh:public_key'), 'key')
+            self.assertEqual(load.call_count, 2)
+        self.assertEqual(PillarManager.get('ses'), {'minions': {'all': ['node1']},
+                                                    'ssh': {'public_key': 'key'}})
+
+    def test_remove_shard(self):
+        with PillarManager.transaction():
+            PillarManager.set('ses:minions:all', ['node1'])
+            PillarManager.set('ses:ssh:public_key', 'key')
+        PillarManager.reset('ses:ssh:public_key')
+        self.assertFalse(os.path.exists(self._path('ses/ssh.sls')))
+        self.assertYamlEqual(self._path('ses.sls'), {'include': ['ses.minions']})
+
+    def test_keep_layout(self):
+        with PillarManager.transaction():
+            PillarManager.set('ses:minions:all', ['node1'])
+            PillarManager.set('ses:ssh:public_key', 'key')
+
+        # runs without the option keep the layout found on disk
+        PillarManager.sharded = None
+        PillarManager.invalidate()
+        PillarManager.set('ses:minions:all', ['node1', 'node2'])
+        self.assertYamlEqual(self._path('ses.sls'), {'include': ['ses.minions', 'ses.ssh']})
+        self.assertYamlEqual(self._path('ses/minions.sls'),
+                             {'ses': {'minions': {'all': ['node1', 'node2']}}})
+        self.assertTrue(os.path.exists(self._path('ses/ssh.sls')))
+
+        PillarManager.sharded = False
+        PillarManager.invalidate()
+        PillarManager.set('ses:minions:all', ['node1'])
+        self.assertYamlEqual(self._path('ses.sls'), {'ses': {'minions': {'all': ['node1']},
+                                                             'ssh': {'public_key': 'key'}}})
+        self.assertFalse(os.path.exists(self._path('ses/ssh.sls')))
+
+
+class JournalPillarManagerTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(JournalPillarManagerTest, self).setUp()
+        PillarManager.journal = True
+        PillarManager.journal_compaction_delay = 3600
+        self.addCleanup(setattr, PillarManager, 'journal', False)
+        self.addCleanup(PillarManager.invalidate)
+
+    def _path(self, file_name):
+        return os.path.join(SaltClient.pillar_fs_path(), file_name)
+
+    def _refresh_jobs(self):
+        return [job for job in self.local_client.local().jobs
+                if job[1] == 'saltutil.pillar_refresh']
+
+    def test_atomic_write(self):
+        PillarManager.journal = False
+        inode = os.stat(self._path('ses.sls')).st_ino
+        PillarManager.set('ses:test:enabled', True)
+        self.assertNotEqual(os.stat(self._path('ses.sls')).st_ino, inode)
+        self.assertEqual(os.listdir(SaltClient.pillar_fs_path()), ['ses.sls'])
+
+    def test_journal_compaction(self):
+        del self.local_client.local().jobs[:]
+        PillarManager.set('ses:test:enabled', True)
+        PillarManager.set('ses:test:name', 'foo')
+        PillarManager.reset('ses:test:name')
+        self.assertEqual(os.path.getsize(self._path('ses.sls')), 0)
+        with open(self._path(PillarManager.JOURNAL_FILE), 'r') as file:
+            self.assertEqual(len(file.readlines()), 3)
+        self.assertTrue(PillarManager.get('ses:test:enabled'))
+        self.assertEqual(self._refresh_jobs(), [])
+
+        PillarManager.compact()
+        self.assertYamlEqual(self._path('ses.sls'), {'ses': {'test': {'enabled': True}}})
+        self.assertFalse(os.path.exists(self._path(PillarManager.JOURNAL_FILE)))
+        self.assertEqual(len(self._refresh_jobs()), 1)
+
+    def test_journal_compaction_due(self):
+        del self.local_client.local().jobs[:]
+        threads = threading.active_count()
+        PillarManager.set('ses:test:enabled', True)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(self._refresh_jobs(), [])
+
+        # the next commit after the delay compacts the earlier changes too
+        PillarManager._journal_started -= PillarManager.journal_compaction_delay
+        PillarManager.set('ses:test:name', 'foo')
+        self.assertYamlEqual(self._path('ses.sls'), {'ses': {'test': {'enabled': True,
+                                                                      'name': 'foo'}}})
+        self.assertFalse(os.path.exists(self._path(PillarManager.JOURNAL_FILE)))
+        self.assertEqual(len(self._refresh_jobs()), 1)
+        self.assertIsNone(PillarManager._journal_started)
+
+    def test_journal_replay(self):
+        PillarManager.set('ses:test:enabled', True)
+        with open(self._path(PillarManager.JOURNAL_FILE), 'a') as file:
+            file.write('{"op": "set", "key": "ses:test:na')
+        PillarManager.invalidate()
+
+        self.assertTrue(PillarManager.get('ses:test:enabled'))
+        self.assertYamlEqual(self._path('ses.sls'), {'ses': {'test': {'enabled': True}}})
+        self.assertFalse(os.path.exists(self._path(PillarManager.JOURNAL_FILE)))
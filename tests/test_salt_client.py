@@ -0,0 +1,27 @@
+# pylint: disable=protected-access
+import unittest
+
+from mock import patch
+
+from sesboot.salt_utils import SaltClient
+
+
+class SaltClientTest(unittest.TestCase):
+
+    def setUp(self):
+        SaltClient._OPTS_ = None
+        self.addCleanup(setattr, SaltClient, '_OPTS_', None)
+        patcher = patch('salt.config.master_config', return_value={
+            'pillar_roots': {'base': ['/srv/pillar', '/srv/other']},
+            'pki_dir': '/etc/salt/pki/master',
+        })
+        self.master_config = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pillar_fs_path(self):
+        self.assertEqual(SaltClient.pillar_fs_path(), '/srv/pillar')
+
+    def test_master_config_parsed_once(self):
+        SaltClient.pillar_fs_path()
+        SaltClient.pki_dir()
+        self.master_config.assert_called_once_with(SaltClient.MASTER_CONFIG)
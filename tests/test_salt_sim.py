@@ -0,0 +1,128 @@
+# pylint: disable=protected-access
+import json
+import os
+import time
+
+from click.testing import CliRunner
+from mock import patch
+from pyfakefs.fake_filesystem_unittest import TestCase
+
+from sesboot import cli
+from sesboot.exceptions import SimulationProfileException
+from sesboot.inventory import InventorySnapshot
+from sesboot.model import SesNodeManager
+from sesboot.salt_sim import SimulatedLocalClient, SimulationProfile
+from sesboot.salt_utils import GrainsManager, MinionKeysManager, PillarManager, SaltClient
+
+
+class SimulatedSaltTest(TestCase):
+
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.addCleanup(setattr, SaltClient, 'simulation', None)
+        self.addCleanup(setattr, SaltClient, '_LOCAL_', None)
+        PillarManager.invalidate()
+        MinionKeysManager.invalidate()
+        SesNodeManager.invalidate()
+
+    def _simulate(self, **settings):
+        SaltClient.simulation = SimulationProfile(seed=1, **settings)
+        SaltClient._LOCAL_ = None
+        return SaltClient.local()
+
+    def test_backend_selected(self):
+        local = self._simulate(minions=3)
+        self.assertIsInstance(local, SimulatedLocalClient)
+        self.assertEqual(SaltClient.pillar_fs_path(), '/tmp/sesboot-simulation/pillar')
+        self.assertEqual(MinionKeysManager.accepted_minions(),
+                         {'node0.sim', 'node1.sim', 'node2.sim'})
+
+    def test_cache_follows_client(self):
+        self._simulate(minions=2)
+        GrainsManager.set_grain('node1.sim', 'ses', {'member': True, 'roles': []})
+        self.assertEqual(set(GrainsManager.cached_grains('ses')), {'node1.sim'})
+        local = self._simulate(minions=3, data_dir='/tmp/other-simulation')
+        self.assertIs(SaltClient.cache().client, local)
+        GrainsManager.set_grain('node2.sim', 'ses', {'member': True, 'roles': []})
+        self.assertEqual(set(GrainsManager.cached_grains('ses')), {'node2.sim'})
+
+    def test_unknown_setting(self):
+        with self.assertRaisesRegex(SimulationProfileException, 'unknown settings: latency'):
+            SimulationProfile(latency=1)
+        self.fs.create_file('/etc/sesboot/simulation.yml', contents='latency: 1\n')
+        with self.assertRaisesRegex(SimulationProfileException,
+                                    "'/etc/sesboot/simulation.yml': unknown settings: latency"):
+            SimulationProfile.load('/etc/sesboot/simulation.yml')
+
+    def test_cli_inventory_snapshot(self):
+        self.fs.create_file('/etc/sesboot/simulation.yml',
+                            contents='minions: 3\ndata_dir: /tmp/sim\nseed: 1\n')
+        with patch.object(InventorySnapshot, 'CACHE_DIR', InventorySnapshot.CACHE_DIR):
+            result = CliRunner().invoke(cli, ['--log-level', 'silent', '--salt-simulation',
+                                              '/etc/sesboot/simulation.yml', 'config',
+                                              '/Cluster/Minions add node*'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        # the snapshot of the real inventory is left untouched
+        self.assertFalse(os.path.exists(os.path.join(InventorySnapshot.CACHE_DIR,
+                                                     InventorySnapshot.FILE)))
+        with open(os.path.join('/tmp/sim/cache', InventorySnapshot.FILE)) as file:
+            self.assertEqual(sorted(json.load(file)['nodes']),
+                             ['node0.sim', 'node1.sim', 'node2.sim'])
+
+    def test_grain_targeting(self):
+        local = self._simulate(minions=4)
+        GrainsManager.set_grains('ses', {'node1.sim': {'member': True, 'roles': ['mon']},
+                                         'node2.sim': {'member': True, 'roles': []}})
+        self.assertEqual(set(GrainsManager.filter_by('ses')), {'node1.sim', 'node2.sim'})
+        self.assertEqual(local.match_grain('ses:roles:mon'), {'node1.sim'})
+        GrainsManager.del_grain(['node1.sim'], 'ses')
+        self.assertEqual(local.match_grain('ses:roles:mon'), set())
+        self.assertEqual(local.match_grain('ses:member:True'), {'node2.sim'})
+
+    def test_compound_target(self):
+        local = self._simulate(minions=12)
+        GrainsManager.set_grains('ses', {minion: {'member': True}
+                                         for minion in ['node1.sim', 'node2.sim', 'node3.sim']})
+        self.assertEqual(local._target('( G@ses:member:True ) and ( node1* or L@node3.sim )',
+                                       'compound'), {'node1.sim', 'node3.sim'})
+        self.assertEqual(local._target('node1* and not G@ses:member:True', 'compound'),
+                         {'node10.sim', 'node11.sim'})
+        with self.assertRaisesRegex(Exception, 'Unsupported compound matcher'):
+            local._target('E@node.*', 'compound')
+
+    def test_grains_persisted(self):
+        self._simulate(minions=2)
+        GrainsManager.set_grain('node1.sim', 'ses', {'member': True, 'roles': ['mgr']})
+        local = self._simulate(minions=2)
+        self.assertEqual(local.match_grain('ses:roles:mgr'), {'node1.sim'})
+
+    def test_latency(self):
+        self._simulate(minions=2, minion_latency=0.01, slow_minions={'node0.sim': 0.3})
+        started = time.monotonic()
+        stream = GrainsManager.iter_grains(['node0.sim', 'node1.sim'], ['fqdn_ip4'])
+        minion, _ = next(stream)
+        self.assertEqual(minion, 'node1.sim')
+        self.assertLess(time.monotonic() - started, 0.25)
+        self.assertEqual([minion for minion, _ in stream], ['node0.sim'])
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_dead_and_dropped_minions(self):
+        self._simulate(minions=3, dead_minions=['node0.sim'], drop_rate=0.0, timeout=0.1)
+        started = time.monotonic()
+        status = GrainsManager.set_grains('ses', {'node0.sim': 1, 'node1.sim': 1})
+        self.assertEqual(status, {'node0.sim': False, 'node1.sim': True})
+        # the job waits for the dead minion until it times out
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+        local = self._simulate(minions=3, drop_rate=1.0, timeout=0.05)
+        status = GrainsManager.set_grains('ses', {'node2.sim': 2})
+        self.assertEqual(status, {'node2.sim': False})
+        # the function ran, only its return was lost
+        self.assertEqual(local.match_grain('ses:2'), {'node2.sim'})
+
+    def test_batch(self):
+        local = self._simulate(minions=4)
+        returns = list(local.cmd_batch('node*', 'test.ping', batch='50%'))
+        self.assertEqual(len(returns), 4)
+        self.assertEqual(len(local.jobs), 2)
+        self.assertTrue(all(job[2] == 'list' and len(job[0]) == 2 for job in local.jobs))
@@ -0,0 +1,219 @@
+# pylint: disable=protected-access
+import json
+import os
+
+from mock import patch
+
+from sesboot.exceptions import GrainsUpdateException, SesNodeHasRolesException
+from sesboot.inventory import InventorySnapshot
+from sesboot.model import SesNode, SesNodeManager
+from sesboot.salt_utils import GrainsManager, MinionKeysManager, PillarManager
+from . import SaltMockTestCase
+
+
+class SesNodeManagerTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(SesNodeManagerTest, self).setUp()
+        SesNodeManager._ses_nodes = {}
+        local = self.local_client.local()
+        local.grains.clear()
+        local.mine.clear()
+        for idx, roles in enumerate([['mon'], ['mgr'], []]):
+            minion = 'node{}.ses'.format(idx + 1)
+            self.fs.create_file(os.path.join('/etc/salt/pki/master/minions', minion))
+            GrainsManager.set_grain(minion, 'ses', {'member': True, 'roles': roles})
+            GrainsManager.set_grain(minion, 'fqdn_ip4', ['10.0.0.{}'.format(idx + 1)])
+        del local.jobs[:]
+
+    def test_ses_node_preloaded(self):
+        node = SesNode('node1.ses', {'ses': {'member': True, 'roles': ['mon']},
+                                     'fqdn_ip4': ['10.0.0.1']})
+        self.assertEqual(node.short_name, 'node1')
+        self.assertEqual(node.roles, {'mon'})
+        self.assertEqual(node.public_ip, '10.0.0.1')
+        self.assertEqual(self.local_client.local().jobs, [])
+
+    def test_ses_node_not_member(self):
+        node = SesNode('node4.ses', {'ses': '', 'fqdn_ip4': []})
+        self.assertEqual(node.roles, set())
+        self.assertIsNone(node.public_ip)
+
+    def test_bulk_load(self):
+        SesNodeManager.membership = 'live'
+        self.addCleanup(setattr, SesNodeManager, 'membership', 'cache')
+        nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(set(nodes), {'node1.ses', 'node2.ses', 'node3.ses'})
+        self.assertEqual(nodes['node1.ses'].roles, {'mon'})
+        self.assertEqual(nodes['node2.ses'].public_ip, '10.0.0.2')
+        item_jobs = [job for job in self.local_client.local().jobs if job[1] == 'grains.item']
+        self.assertEqual(len(item_jobs), 1)
+        self.assertEqual(item_jobs[0][2], 'list')
+        self.assertEqual(len(self.local_client.local().jobs), 2)
+        self.assertIsNone(nodes['node1.ses'].cache_age())
+
+    def test_cached_load(self):
+        local = self.local_client.local()
+        # minions without an accepted key are ignored
+        GrainsManager.set_grain('node4.ses', 'ses', {'member': True, 'roles': []})
+        del local.jobs[:]
+        nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(local.jobs, [])
+        self.assertEqual(set(nodes), {'node1.ses', 'node2.ses', 'node3.ses'})
+        self.assertEqual(nodes['node1.ses'].roles, {'mon'})
+        self.assertEqual(nodes['node2.ses'].public_ip, '10.0.0.2')
+        self.assertIsNotNone(nodes['node1.ses'].cache_age())
+
+        SesNodeManager.revalidate(live=True)
+        self.assertEqual([job[1] for job in local.jobs], ['test.ping', 'grains.item'])
+        self.assertIsNone(SesNodeManager.ses_nodes()['node1.ses'].cache_age())
+
+    def test_no_cache(self):
+        with patch.object(GrainsManager, 'cached_grains', return_value=None):
+            nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(set(nodes), {'node1.ses', 'node2.ses', 'node3.ses'})
+        self.assertEqual(len(self.local_client.local().jobs), 2)
+
+    def test_save_nodes(self):
+        nodes = SesNodeManager.ses_nodes()
+        nodes['node1.ses'].add_role('mgr')
+        nodes['node3.ses'].add_role('mgr')
+        nodes['node3.ses'].add_role('mon')
+        del self.local_client.local().jobs[:]
+        SesNodeManager.save_nodes([nodes['node1.ses'], nodes['node3.ses']])
+        self.assertEqual(len(self.local_client.local().jobs), 1)
+        self.assertGrains('node3.ses', 'ses', {'member': True, 'roles': ['mgr', 'mon']})
+
+    def test_save_nodes_failure(self):
+        nodes = SesNodeManager.ses_nodes()
+        with patch.object(GrainsManager, 'set_grains',
+                          return_value={'node1.ses': True, 'node2.ses': False}):
+            with self.assertRaises(GrainsUpdateException) as ctx:
+                SesNodeManager.save_nodes([nodes['node1.ses'], nodes['node2.ses']])
+        self.assertEqual(ctx.exception.minions, ['node2.ses'])
+
+    def test_add_nodes(self):
+        SesNodeManager.ses_nodes()
+        local = self.local_client.local()
+        for idx in range(4, 8):
+            GrainsManager.set_grain('node{}.ses'.format(idx), 'fqdn_ip4', ['10.0.0.{}'.format(idx)])
+        del local.jobs[:]
+        # the grains of node8 are not cached yet
+        SesNodeManager.add_nodes(['node{}.ses'.format(idx) for idx in range(4, 9)])
+        self.assertEqual([job[1] for job in local.jobs],
+                         ['grains.item', 'grains.setval', 'saltutil.pillar_refresh'])
+        self.assertEqual(local.jobs[0][0], ['node8.ses'])
+        nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(len(nodes), 8)
+        self.assertEqual(nodes['node5.ses'].public_ip, '10.0.0.5')
+        self.assertGrains('node7.ses', 'ses', {'member': True, 'roles': []})
+
+    def test_add_nodes_cached(self):
+        SesNodeManager.ses_nodes()
+        local = self.local_client.local()
+        GrainsManager.set_grain('node4.ses', 'fqdn_ip4', ['10.0.0.4'])
+        del local.jobs[:]
+        SesNodeManager.add_nodes(['node4.ses'])
+        SesNodeManager.ses_nodes()['node4.ses'].add_role('mon')
+        SesNodeManager.save_in_pillar()
+        self.assertEqual([job[1] for job in local.jobs],
+                         ['grains.setval', 'saltutil.pillar_refresh', 'saltutil.pillar_refresh'])
+        self.assertEqual(PillarManager.get('ses:minions:mon'),
+                         {'node1': '10.0.0.1', 'node4': '10.0.0.4'})
+
+    def test_public_ip_from_mine(self):
+        SesNodeManager.public_ip_mine_function = 'network.ip_addrs'
+        self.addCleanup(setattr, SesNodeManager, 'public_ip_mine_function', None)
+        local = self.local_client.local()
+        local.mine['node1.ses'] = {'network.ip_addrs': ['192.168.0.1', '10.0.0.1']}
+        nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(local.jobs, [])
+        self.assertEqual(nodes['node1.ses'].public_ip, '192.168.0.1')
+        # minions without mine data fall back to the grain
+        self.assertEqual(nodes['node2.ses'].public_ip, '10.0.0.2')
+
+    def test_minion_data_cache_invalidation(self):
+        cache = self.local_client.cache()
+        cache.updated_at -= 60
+        with patch.object(self.local_client, 'cache', return_value=cache):
+            self.assertEqual(SesNodeManager.ses_nodes()['node1.ses'].public_ip, '10.0.0.1')
+            GrainsManager.set_grain('node1.ses', 'fqdn_ip4', ['10.0.1.1'])
+
+            # the master did not update its cache entry yet
+            SesNodeManager.revalidate()
+            self.assertEqual(SesNodeManager.ses_nodes()['node1.ses'].public_ip, '10.0.0.1')
+
+            # the minion restarted or refreshed its grains
+            cache.updated_at += 30
+            SesNodeManager.revalidate()
+            self.assertEqual(SesNodeManager.ses_nodes()['node1.ses'].public_ip, '10.0.1.1')
+
+    def test_remove_nodes(self):
+        SesNodeManager.ses_nodes()
+        with self.assertRaises(SesNodeHasRolesException):
+            SesNodeManager.remove_nodes(['node3.ses', 'node1.ses'])
+        self.assertEqual(len(SesNodeManager.ses_nodes()), 3)
+
+        SesNodeManager.ses_nodes()['node2.ses'].roles.clear()
+        local = self.local_client.local()
+        del local.jobs[:]
+        SesNodeManager.remove_nodes(['node2.ses', 'node3.ses'])
+        self.assertEqual([job[1] for job in local.jobs],
+                         ['grains.delkey', 'saltutil.pillar_refresh', 'saltutil.pillar_refresh'])
+        self.assertEqual(local.jobs[1][0], ['node2.ses', 'node3.ses'])
+        self.assertEqual(set(SesNodeManager.ses_nodes()), {'node1.ses'})
+        self.assertNotInGrains('node3.ses', 'ses')
+
+    def test_remove_nodes_cache(self):
+        SesNodeManager.ses_nodes()['node2.ses'].roles.clear()
+        # the master does not see a deleted grain until the minion refreshes
+        with patch.object(GrainsManager, 'refresh_cache'):
+            SesNodeManager.remove_nodes(['node3.ses'])
+        self.assertIn('node3.ses', GrainsManager.cached_grains('ses'))
+
+        SesNodeManager.remove_nodes(['node2.ses'])
+        self.assertNotIn('node2.ses', GrainsManager.cached_grains('ses'))
+        SesNodeManager.revalidate()
+        self.assertNotIn('node2.ses', SesNodeManager.ses_nodes())
+
+    def test_snapshot_saved(self):
+        self.fs.create_file('/etc/salt/pki/master/minions/node4.ses')
+        SesNodeManager.ses_nodes()
+        with open(os.path.join(InventorySnapshot.CACHE_DIR, InventorySnapshot.FILE)) as file:
+            snapshot = json.load(file)
+        self.assertEqual(snapshot['version'], InventorySnapshot.VERSION)
+        self.assertEqual(snapshot['nodes']['node1.ses'], {'roles': ['mon'],
+                                                          'public_ip': '10.0.0.1'})
+        self.assertEqual(snapshot['minions'], ['node1.ses', 'node2.ses', 'node3.ses', 'node4.ses'])
+        self.assertIsNone(SesNodeManager.snapshot_age())
+
+    def test_snapshot_first_paint(self):
+        SesNodeManager.ses_nodes()
+        SesNodeManager.invalidate()
+        local = self.local_client.local()
+        self.fs.create_file('/etc/salt/pki/master/minions/node4.ses')
+        MinionKeysManager.invalidate()
+        GrainsManager.set_grain('node4.ses', 'ses', {'member': True, 'roles': []})
+        del local.jobs[:]
+
+        nodes = SesNodeManager.ses_nodes()
+        self.assertEqual(local.jobs, [])
+        self.assertEqual(set(nodes), {'node1.ses', 'node2.ses', 'node3.ses'})
+        self.assertEqual(nodes['node2.ses'].roles, {'mgr'})
+        self.assertEqual(nodes['node3.ses'].public_ip, '10.0.0.3')
+        self.assertIsNotNone(SesNodeManager.snapshot_age())
+
+        # changes are always made on top of the live inventory
+        SesNodeManager.remove_nodes(['node3.ses'])
+        self.assertIsNone(SesNodeManager.snapshot_age())
+        self.assertEqual(set(SesNodeManager.ses_nodes()), {'node1.ses', 'node2.ses', 'node4.ses'})
+
+        SesNodeManager.invalidate()
+        self.assertEqual(set(SesNodeManager.ses_nodes()), {'node1.ses', 'node2.ses', 'node4.ses'})
+
+    def test_snapshot_other_version(self):
+        SesNodeManager.ses_nodes()
+        SesNodeManager.invalidate()
+        with patch.object(InventorySnapshot, 'VERSION', InventorySnapshot.VERSION + 1):
+            SesNodeManager.ses_nodes()
+        self.assertIsNone(SesNodeManager.snapshot_age())